@@ -8,6 +8,8 @@
 __author__ = "Benny <benny.think@gmail.com>"
 
 import os
+import socket
+import tempfile
 
 
 def get_env(name: str, default=None):
@@ -34,14 +36,70 @@ OWNER = [int(i) for i in str(get_env("OWNER")).split(",")]
 AUTHORIZED_USER: str = get_env("AUTHORIZED_USER", "")
 DB_DSN = get_env("DB_DSN")
 REDIS_HOST = get_env("REDIS_HOST")
+# yt-dlp extraction results are reused for this many seconds
+INFO_CACHE_TTL: int = get_env("INFO_CACHE_TTL", 1800)
+# stream URLs are often bound to the IP that extracted them, only nodes with the same scope share results.
+# defaults to the hostname, nodes behind one egress IP can set the same value
+INFO_CACHE_SCOPE = str(get_env("INFO_CACHE_SCOPE") or socket.gethostname())
+# file_id cache: auto keeps it in Redis, or in SQLite at CACHE_DB_PATH when Redis is unreachable
+CACHE_BACKEND = get_env("CACHE_BACKEND", "auto")
+# next to the staging directory by default, not in the working directory
+CACHE_DB_PATH = get_env("CACHE_DB_PATH") or os.path.join(
+    get_env("TMPFILE_PATH") or tempfile.gettempdir(), "ytdlbot-cache.sqlite3"
+)
+# entries expire this many seconds after their last use, beyond CACHE_MAX_ENTRIES the least recently used go
+CACHE_TTL: int = get_env("CACHE_TTL", 30 * 86400)
+CACHE_MAX_ENTRIES: int = get_env("CACHE_MAX_ENTRIES", 100000)
+# entries also kept in memory by each process
+CACHE_LOCAL_SIZE: int = get_env("CACHE_LOCAL_SIZE", 1024)
+# user settings and quota are cached in Redis for this many seconds, writes invalidate them
+PROFILE_CACHE_TTL: int = get_env("PROFILE_CACHE_TTL", 600)
+# quota is spent in Redis and written back to MySQL every this many seconds
+QUOTA_FLUSH_INTERVAL: int = get_env("QUOTA_FLUSH_INTERVAL", 30)
+# free quota is topped up lazily, this also resets it in MySQL at midnight for reporting
+BULK_FREE_RESET = get_env("BULK_FREE_RESET", False)
 
 ENABLE_FFMPEG = get_env("ENABLE_FFMPEG")
 AUDIO_FORMAT = get_env("AUDIO_FORMAT", "m4a")
 M3U8_SUPPORT = get_env("M3U8_SUPPORT")
 ENABLE_ARIA2 = get_env("ENABLE_ARIA2")
+# leave ARIA2_RPC_URL empty to start a local aria2c daemon
+ARIA2_RPC_URL = get_env("ARIA2_RPC_URL")
+ARIA2_RPC_SECRET = get_env("ARIA2_RPC_SECRET")
+ARIA2_RPC_PORT: int = get_env("ARIA2_RPC_PORT", 6800)
+ARIA2_MAX_CONCURRENT: int = get_env("ARIA2_MAX_CONCURRENT", 8)
+ARIA2_SPEED_LIMIT = get_env("ARIA2_SPEED_LIMIT", "0")
+# parallel connections for direct downloads without aria2
+DIRECT_CONNECTIONS: int = get_env("DIRECT_CONNECTIONS", 8)
+# upload direct downloads to Telegram while they are still downloading
+STREAM_UPLOAD = get_env("STREAM_UPLOAD", True)
 
 RCLONE_PATH = get_env("RCLONE")
 
+# HTTP client settings for direct, instagram and krakenfiles engines
+HTTP_POOL_SIZE: int = get_env("HTTP_POOL_SIZE", 32)
+HTTP_CONNECT_TIMEOUT: int = get_env("HTTP_CONNECT_TIMEOUT", 10)
+HTTP_READ_TIMEOUT: int = get_env("HTTP_READ_TIMEOUT", 60)
+HTTP_RETRIES: int = get_env("HTTP_RETRIES", 3)
+# HTTP/2 is experimental in urllib3 and needs the h2 package, it applies to the whole process
+ENABLE_HTTP2 = get_env("ENABLE_HTTP2")
+
+# ffmpeg/ffprobe processes running at the same time on this node, for thumbnails, probing and splitting
+# .env.example ships it empty, which means the default as well
+FFMPEG_WORKERS: int = int(get_env("FFMPEG_WORKERS") or os.cpu_count() or 2)
+# files over the Telegram limit are split into up to this many parts(at most 10), 1 disables splitting
+SPLIT_MAX_PARTS: int = get_env("SPLIT_MAX_PARTS", 4)
+
+# progress edits: at most once per EDIT_INTERVAL seconds per message, EDIT_CHAT_RATE per minute per chat
+# and EDIT_GLOBAL_RATE per second for the whole bot
+EDIT_INTERVAL: int = get_env("EDIT_INTERVAL", 5)
+EDIT_CHAT_RATE: int = get_env("EDIT_CHAT_RATE", 20)
+EDIT_GLOBAL_RATE: int = get_env("EDIT_GLOBAL_RATE", 20)
+
+# download queue settings
+MAX_CONCURRENT_DOWNLOADS: int = get_env("MAX_CONCURRENT_DOWNLOADS", 16)
+MAX_USER_DOWNLOADS: int = get_env("MAX_USER_DOWNLOADS", 2)
+
 # payment settings
 ENABLE_VIP = get_env("ENABLE_VIP")
 PROVIDER_TOKEN = get_env("PROVIDER_TOKEN")
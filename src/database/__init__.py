@@ -3,4 +3,4 @@
 
 # ytdlbot - __init__.py.py
 
-from database.cache import Redis
+from database.cache import InfoCache, LeaseBusy, Redis, cache_backend, lease_watcher, redis_client
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# ytdlbot - backend.py
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict, defaultdict
+
+import redis
+
+EVENTS = ("hits", "misses", "evictions")
+
+
+class CacheStats:
+    """
+    Hit, miss and eviction counters of this process, per cache tier and source domain.
+    Only the first `max_domains` domains get their own counters, later ones are counted as "other".
+    """
+
+    def __init__(self, max_domains: int = 200):
+        self._counts: defaultdict[tuple[str, str, str], int] = defaultdict(int)
+        self._domains: set[str] = set()
+        self._max_domains = max_domains
+        self._lock = threading.Lock()
+
+    def record(self, tier: str, domain: str, event: str, n: int = 1):
+        if n:
+            domain = domain or "unknown"
+            with self._lock:
+                if domain not in self._domains:
+                    if len(self._domains) >= self._max_domains:
+                        domain = "other"
+                    else:
+                        self._domains.add(domain)
+                self._counts[(tier, domain, event)] += n
+
+    def snapshot(self) -> dict[str, dict[str, dict[str, int]]]:
+        """tier -> domain -> event -> count"""
+        result = {}
+        with self._lock:
+            for (tier, domain, event), count in self._counts.items():
+                result.setdefault(tier, {}).setdefault(domain, dict.fromkeys(EVENTS, 0))[event] = count
+        return result
+
+
+cache_stats = CacheStats()
+
+
+class CacheBackend(ABC):
+    """Where the file_id cache lives, entries are flat dicts of strings. `domain` only labels the counters."""
+
+    name = "backend"
+
+    @abstractmethod
+    def get(self, key: str, domain: str = "") -> dict:
+        """The entry, or an empty dict."""
+
+    @abstractmethod
+    def set(self, key: str, mapping: dict, domain: str = ""):
+        pass
+
+    def get_many(self, *keys: str, domain: str = "") -> list[dict]:
+        return [self.get(key, domain) for key in keys]
+
+
+class RedisBackend(CacheBackend):
+    """
+    Entries are hashes that expire `ttl` seconds after their last use. A sorted set indexes them by last use,
+    beyond `max_entries` the least recently used are deleted.
+    """
+
+    name = "redis"
+    INDEX = "cache:index"
+    # key -> domain it was first stored from, only for the eviction counters.
+    # one entry can be reached from several domains, e.g. youtu.be and youtube.com
+    DOMAINS = "cache:domains"
+    # set once the entries written before the index existed have been adopted
+    MIGRATED = "cache:index:migrated"
+    # cache keys are md5 hex digests
+    KEY_PATTERN = "[0-9a-f]" * 32
+
+    def __init__(self, client: redis.StrictRedis, ttl: int, max_entries: int):
+        self._r = client
+        self._ttl = ttl
+        self._max_entries = max_entries
+        if not self._r.exists(self.MIGRATED):
+            threading.Thread(target=self._index_existing, name="cache-migration", daemon=True).start()
+
+    def _index_existing(self, batch: int = 1000):
+        """Entries of older versions have no TTL and aren't in the index, so they'd never be evicted."""
+        adopted = 0
+        try:
+            keys = []
+            for key in self._r.scan_iter(match=self.KEY_PATTERN, count=batch, _type="hash"):
+                keys.append(key)
+                if len(keys) >= batch:
+                    adopted += self._adopt(keys)
+                    keys = []
+            adopted += self._adopt(keys)
+            self._r.set(self.MIGRATED, 1)
+        except redis.RedisError as e:
+            # the marker isn't set, the next start continues, adopting an entry twice does no harm
+            logging.error("Indexing existing cache entries failed: %s", e)
+            return
+        logging.info("Indexed %s existing cache entries", adopted)
+        if (count := self._r.zcard(self.INDEX)) > self._max_entries:
+            self._evict(count - self._max_entries)
+
+    def _adopt(self, keys: list[str]) -> int:
+        if not keys:
+            return 0
+        with self._r.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.ttl(key)
+            legacy = [key for key, ttl in zip(keys, pipe.execute()) if ttl == -1]
+        if not legacy:
+            return 0
+        now = time.time()
+        with self._r.pipeline(transaction=False) as pipe:
+            for key in legacy:
+                pipe.expire(key, self._ttl)
+                # the source domain of old entries is unknown, they count as "unknown" when evicted
+                pipe.zadd(self.INDEX, {key: now}, nx=True)
+            pipe.execute()
+        return len(legacy)
+
+    def get(self, key: str, domain: str = "") -> dict:
+        return self.get_many(key, domain=domain)[0]
+
+    def get_many(self, *keys: str, domain: str = "") -> list[dict]:
+        now = time.time()
+        # one round trip, which also refreshes the TTL and last use of the entries that exist
+        with self._r.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.hgetall(key)
+                pipe.expire(key, self._ttl)
+                pipe.zadd(self.INDEX, {key: now}, xx=True)
+            entries = pipe.execute()[::3]
+        hits = sum(1 for entry in entries if entry)
+        cache_stats.record(self.name, domain, "hits", hits)
+        cache_stats.record(self.name, domain, "misses", len(entries) - hits)
+        return entries
+
+    def set(self, key: str, mapping: dict, domain: str = ""):
+        with self._r.pipeline(transaction=False) as pipe:
+            pipe.hset(key, mapping=mapping)
+            pipe.expire(key, self._ttl)
+            pipe.zadd(self.INDEX, {key: time.time()})
+            if domain:
+                pipe.hsetnx(self.DOMAINS, key, domain)
+            pipe.zcard(self.INDEX)
+            count = pipe.execute()[-1]
+        if count > self._max_entries:
+            self._evict(count - self._max_entries)
+
+    def _evict(self, n: int):
+        # entries unused for longer than the TTL are gone already, only their index entries are left
+        if expired := self._r.zrangebyscore(self.INDEX, "-inf", time.time() - self._ttl):
+            with self._r.pipeline(transaction=False) as pipe:
+                pipe.zrem(self.INDEX, *expired)
+                pipe.hdel(self.DOMAINS, *expired)
+                pipe.execute()
+            n -= len(expired)
+        if n <= 0:
+            return
+        keys = [key for key, _ in self._r.zpopmin(self.INDEX, n)]
+        if not keys:
+            return
+        with self._r.pipeline(transaction=False) as pipe:
+            pipe.hmget(self.DOMAINS, keys)
+            pipe.hdel(self.DOMAINS, *keys)
+            pipe.delete(*keys)
+            domains = pipe.execute()[0]
+        for domain in domains:
+            cache_stats.record(self.name, domain or "", "evictions")
+        logging.info("Evicted %s entries from the Redis cache", len(keys))
+
+
+class SQLiteBackend(CacheBackend):
+    """
+    The cache in an embedded SQLite database, kept across restarts without any external service.
+    Entries expire `ttl` seconds after they were last used, beyond `max_entries` the least recently used go first.
+    """
+
+    name = "sqlite"
+    # enforcing the bound needs a count, so it's only done every this many writes
+    EVICT_EVERY = 100
+
+    def __init__(self, path: str, ttl: int, max_entries: int):
+        self._ttl = ttl
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self._writes = 0
+        # autocommit, each statement is its own transaction
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS cache "
+            "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(cache)")}
+        if "domain" not in columns:
+            self._db.execute("ALTER TABLE cache ADD COLUMN domain TEXT NOT NULL DEFAULT ''")
+        with self._lock:
+            self._evict()
+        logging.info("Using SQLite cache at %s", path)
+
+    def get(self, key: str, domain: str = "") -> dict:
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT value, expires FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is not None and row[1] <= now:
+                self._db.execute("DELETE FROM cache WHERE key = ?", (key,))
+                row = None
+            if row is None:
+                cache_stats.record(self.name, domain, "misses")
+                return {}
+            self._db.execute("UPDATE cache SET expires = ?, accessed = ? WHERE key = ?", (now + self._ttl, now, key))
+        cache_stats.record(self.name, domain, "hits")
+        return json.loads(row[0])
+
+    def set(self, key: str, mapping: dict, domain: str = ""):
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires, accessed, domain) VALUES (?, ?, ?, ?, ?)",
+                (key, json.dumps(mapping, ensure_ascii=False), now + self._ttl, now, domain),
+            )
+            self._writes += 1
+            if self._writes % self.EVICT_EVERY == 0:
+                self._evict()
+
+    def _evict(self):
+        self._db.execute("DELETE FROM cache WHERE expires <= ?", (time.time(),))
+        (count,) = self._db.execute("SELECT COUNT(*) FROM cache").fetchone()
+        if count <= self._max_entries:
+            return
+        rows = self._db.execute(
+            "SELECT key, domain FROM cache ORDER BY accessed LIMIT ?", (count - self._max_entries,)
+        ).fetchall()
+        self._db.executemany("DELETE FROM cache WHERE key = ?", [(key,) for key, _ in rows])
+        for _, domain in rows:
+            cache_stats.record(self.name, domain, "evictions")
+        logging.info("Evicted %s entries from the SQLite cache", len(rows))
+
+
+class TieredCache(CacheBackend):
+    """
+    A bounded in-process LRU in front of another backend, so hot entries don't cost a round trip.
+    Local copies live for `ttl` seconds only, the backend refreshes its own TTL when they are fetched again.
+    """
+
+    name = "local"
+
+    def __init__(self, backend: CacheBackend, maxsize: int, ttl: int = 300):
+        self.backend = backend
+        self._maxsize = maxsize
+        self._ttl = ttl
+        # key -> (expires, domain, entry)
+        self._local: OrderedDict[str, tuple[float, str, dict]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str, domain: str = "") -> dict:
+        return self.get_many(key, domain=domain)[0]
+
+    def get_many(self, *keys: str, domain: str = "") -> list[dict]:
+        now = time.monotonic()
+        found = {}
+        with self._lock:
+            for key in keys:
+                if item := self._local.get(key):
+                    if item[0] > now:
+                        self._local.move_to_end(key)
+                        found[key] = dict(item[2])
+                    else:
+                        del self._local[key]
+        cache_stats.record(self.name, domain, "hits", len(found))
+        cache_stats.record(self.name, domain, "misses", len(keys) - len(found))
+
+        if missing := [key for key in keys if key not in found]:
+            for key, entry in zip(missing, self.backend.get_many(*missing, domain=domain)):
+                if entry:
+                    self._put(key, entry, domain)
+                    found[key] = entry
+        return [found.get(key, {}) for key in keys]
+
+    def set(self, key: str, mapping: dict, domain: str = ""):
+        self.backend.set(key, mapping, domain)
+        self._put(key, mapping, domain)
+
+    def _put(self, key: str, entry: dict, domain: str):
+        with self._lock:
+            self._local[key] = (time.monotonic() + self._ttl, domain, dict(entry))
+            self._local.move_to_end(key)
+            while len(self._local) > self._maxsize:
+                _, (_, evicted, _) = self._local.popitem(last=False)
+                cache_stats.record(self.name, evicted, "evictions")
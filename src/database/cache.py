@@ -4,28 +4,288 @@
 # ytdlbot - cache.py
 
 
+import copy
+import json
 import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Any, Callable
 
 import fakeredis
 import redis
+from redis.backoff import ExponentialBackoff
+from redis.retry import Retry
 
-from config import REDIS_HOST
+from config import (
+    CACHE_BACKEND,
+    CACHE_DB_PATH,
+    CACHE_LOCAL_SIZE,
+    CACHE_MAX_ENTRIES,
+    CACHE_TTL,
+    INFO_CACHE_SCOPE,
+    INFO_CACHE_TTL,
+    REDIS_HOST,
+)
+from database.backend import CacheBackend, RedisBackend, SQLiteBackend, TieredCache
+
+LEASE_TTL = 120
+MAX_CONNECTIONS = 64
+# idle connections are pinged before use after this many seconds, dead ones are replaced transparently
+HEALTH_CHECK_INTERVAL = 30
+
+_client: redis.StrictRedis | None = None
+_backend: CacheBackend | None = None
+_client_lock = threading.Lock()
+
+
+def _connect() -> redis.StrictRedis:
+    pool = redis.BlockingConnectionPool(
+        host=REDIS_HOST,
+        db=1,
+        decode_responses=True,
+        max_connections=MAX_CONNECTIONS,
+        health_check_interval=HEALTH_CHECK_INTERVAL,
+        socket_connect_timeout=5,
+        socket_keepalive=True,
+        # reconnect and retry when Redis restarts or a connection drops
+        retry=Retry(ExponentialBackoff(cap=2, base=0.1), 3),
+        retry_on_error=[redis.ConnectionError, redis.TimeoutError],
+    )
+    client = redis.StrictRedis(connection_pool=pool)
+    try:
+        client.ping()
+        return client
+    except redis.RedisError:
+        pool.disconnect()
+        logging.warning("Redis connection failed, using fake redis instead.")
+        return fakeredis.FakeStrictRedis(server=fakeredis.FakeServer(), decode_responses=True)
+
+
+def redis_client() -> redis.StrictRedis:
+    """
+    The Redis client of this process, all of its users share one connection pool.
+    If Redis is unreachable at startup, they all share one in-memory fake instead.
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = _connect()
+    return _client
+
+
+def cache_backend() -> CacheBackend:
+    """
+    The file_id cache of this process. With CACHE_BACKEND=auto it lives in Redis, or in SQLite if Redis
+    is unreachable, so a single node without Redis keeps a warm cache across restarts.
+    Either way a small in-process LRU sits in front of it.
+    """
+    global _backend
+    if _backend is None:
+        client = redis_client()
+        with _client_lock:
+            if _backend is None:
+                fake = isinstance(client, fakeredis.FakeStrictRedis)
+                if CACHE_BACKEND == "sqlite" or (CACHE_BACKEND == "auto" and fake):
+                    backend = SQLiteBackend(CACHE_DB_PATH, CACHE_TTL, CACHE_MAX_ENTRIES)
+                else:
+                    backend = RedisBackend(client, CACHE_TTL, CACHE_MAX_ENTRIES)
+                _backend = TieredCache(backend, CACHE_LOCAL_SIZE)
+    return _backend
 
 
 class Redis:
-    def __init__(self):
+    # cheap, every instance uses the shared client and cache backend, created on first use,
+    # so importing a module with a module-level instance doesn't connect
+
+    @property
+    def r(self) -> redis.StrictRedis:
+        return redis_client()
+
+    @property
+    def backend(self) -> CacheBackend:
+        return cache_backend()
+
+    def add_cache(self, key, mapping, domain: str = ""):
+        self.backend.set(key, mapping, domain)
+
+    def get_cache(self, k: str, domain: str = ""):
+        return self.backend.get(k, domain)
+
+    def get_caches(self, *keys: str, domain: str = "") -> list[dict]:
+        """Several cache entries, in one round trip where the backend allows it."""
+        return self.backend.get_many(*keys, domain=domain)
+
+    def _release_lease(self, name: str, token: str):
+        # only delete the lease if we still own it, it might have expired and been taken by someone else
+        with self.r.pipeline() as pipe:
+            try:
+                pipe.watch(name)
+                if pipe.get(name) == token:
+                    pipe.multi()
+                    pipe.delete(name)
+                    pipe.publish(name, "done")
+                    pipe.execute()
+            except redis.WatchError:
+                pass
+
+    @contextmanager
+    def lease(self, key: str, ttl: int = LEASE_TTL):
+        """
+        Try to take the exclusive lease for key, yields whether it was acquired.
+        The lease is renewed in background while held, so it only expires if this process dies.
+        """
+        name, token = f"lease:{key}", uuid.uuid4().hex
+        if not self.r.set(name, token, nx=True, ex=ttl):
+            yield False
+            return
+
+        stop = threading.Event()
+
+        def renew():
+            while not stop.wait(ttl / 3):
+                if self.r.get(name) != token or not self.r.expire(name, ttl):
+                    logging.warning("Lost lease %s", name)
+                    return
+
+        threading.Thread(target=renew, daemon=True).start()
         try:
-            self.r = redis.StrictRedis(host=REDIS_HOST, db=1, decode_responses=True)
-            self.r.ping()
-        except Exception:
-            logging.warning("Redis connection failed, using fake redis instead.")
-            self.r = fakeredis.FakeStrictRedis(host=REDIS_HOST, db=1, decode_responses=True)
+            yield True
+        finally:
+            stop.set()
+            self._release_lease(name, token)
+
+    def on_release(self, key: str, callback: Callable[..., Any], *args):
+        """Call back once the lease for key is released or expired, without blocking the caller."""
+        lease_watcher().watch(f"lease:{key}", callback, *args)
+
+
+class LeaseBusy(Exception):
+    """Another job holds the lease, the caller should retry once it's released instead of waiting."""
+
+    def __init__(self, key: str):
+        super().__init__(f"lease {key} is held by another job")
+        self.key = key
+
+
+class LeaseWatcher:
+    """
+    One thread watching all leases that jobs are waiting for, so a waiting job doesn't occupy a worker.
+    Released leases are announced on their channel, expired ones are noticed by checking every second.
+    """
+
+    def __init__(self, client: redis.StrictRedis):
+        self._r = client
+        # lease name -> callbacks with their arguments
+        self._waiting: dict[str, list[tuple[Callable[..., Any], tuple]]] = {}
+        self._cond = threading.Condition()
+        self._thread: threading.Thread | None = None
+
+    def watch(self, name: str, callback: Callable[..., Any], *args):
+        with self._cond:
+            self._waiting.setdefault(name, []).append((callback, args))
+            self._cond.notify()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="lease-watcher", daemon=True)
+                self._thread.start()
+
+    def pending(self) -> int:
+        with self._cond:
+            return sum(len(callbacks) for callbacks in self._waiting.values())
+
+    def _run(self):
+        pubsub, subscribed = self._r.pubsub(ignore_subscribe_messages=True), set()
+        while True:
+            with self._cond:
+                while not self._waiting:
+                    self._cond.wait()
+                names = set(self._waiting)
+            try:
+                if new := names - subscribed:
+                    pubsub.subscribe(*new)
+                if gone := subscribed - names:
+                    pubsub.unsubscribe(*gone)
+                subscribed = names
+                # subscribed first and checked afterward, so no release can be missed
+                released = set()
+                if message := pubsub.get_message(timeout=1):
+                    released.add(message["channel"])
+                ordered = list(names)
+                with self._r.pipeline(transaction=False) as pipe:
+                    for name in ordered:
+                        pipe.exists(name)
+                    released.update(name for name, exists in zip(ordered, pipe.execute()) if not exists)
+            except redis.RedisError as e:
+                logging.warning("Lease watcher failed: %s", e)
+                pubsub, subscribed = self._r.pubsub(ignore_subscribe_messages=True), set()
+                time.sleep(1)
+                continue
+
+            with self._cond:
+                callbacks = [item for name in released for item in self._waiting.pop(name, [])]
+            for callback, args in callbacks:
+                try:
+                    callback(*args)
+                except Exception:
+                    logging.error("Lease callback %s failed", callback, exc_info=True)
+
+
+_watcher: LeaseWatcher | None = None
+
+
+def lease_watcher() -> LeaseWatcher:
+    global _watcher
+    if _watcher is None:
+        with _client_lock:
+            if _watcher is None:
+                _watcher = LeaseWatcher(redis_client())
+    return _watcher
+
+
+class InfoCache:
+    """
+    TTL-bounded cache of sanitized yt-dlp info dicts, an in-process LRU in front of Redis.
+    Stream URLs inside the info dict expire on most sites, so the TTL should stay well below that.
+    Many sites also bind them to the IP that extracted them, so Redis entries are only shared within `scope`.
+    """
+
+    def __init__(self, maxsize: int = 256, ttl: int = INFO_CACHE_TTL, scope: str = INFO_CACHE_SCOPE):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._prefix = f"info:{scope}:"
+        self._local: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._redis = Redis()
+
+    def get(self, key: str) -> dict | None:
+        now = time.time()
+        with self._lock:
+            if item := self._local.get(key):
+                expires, info = item
+                if expires > now:
+                    self._local.move_to_end(key)
+                    # callers are free to mutate what they get, i.e. yt-dlp's process_ie_result does
+                    return copy.deepcopy(info)
+                del self._local[key]
 
-    def __del__(self):
-        self.r.close()
+        with self._redis.r.pipeline(transaction=False) as pipe:
+            raw, ttl = pipe.get(self._prefix + key).ttl(self._prefix + key).execute()
+        if not raw:
+            return None
+        info = json.loads(raw)
+        self._set_local(key, info, now + (ttl if ttl > 0 else self._ttl))
+        return copy.deepcopy(info)
 
-    def add_cache(self, key, mapping):
-        self.r.hset(key, mapping=mapping)
+    def set(self, key: str, info: dict):
+        self._redis.r.set(self._prefix + key, json.dumps(info, ensure_ascii=False), ex=self._ttl)
+        self._set_local(key, copy.deepcopy(info), time.time() + self._ttl)
 
-    def get_cache(self, k: str):
-        return self.r.hgetall(k)
+    def _set_local(self, key: str, info: dict, expires: float):
+        with self._lock:
+            self._local[key] = (expires, info)
+            self._local.move_to_end(key)
+            while len(self._local) > self._maxsize:
+                self._local.popitem(last=False)
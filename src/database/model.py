@@ -1,9 +1,14 @@
 #!/usr/bin/env python3
 # coding: utf-8
+import json
 import logging
 import math
 import os
+import threading
+import time
 from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from datetime import date
 from typing import Literal
 
 from sqlalchemy import (
@@ -14,13 +19,17 @@ from sqlalchemy import (
     ForeignKey,
     Integer,
     String,
+    bindparam,
     create_engine,
+    func,
+    update,
 )
 from sqlalchemy.dialects.mysql import JSON
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, sessionmaker
 
-from config import ENABLE_VIP, FREE_DOWNLOAD
+from config import ENABLE_VIP, FREE_DOWNLOAD, PROFILE_CACHE_TTL
+from database.cache import Redis
 
 
 class PaymentStatus:
@@ -106,21 +115,81 @@ def session_manager():
         s.close()
 
 
-def get_quality_settings(tgid) -> Literal["high", "medium", "low", "audio", "custom"]:
+@dataclass(frozen=True)
+class UserProfile:
+    """Everything a job needs to know about a user, read with a single query."""
+
+    user_id: int
+    exists: bool = False
+    free: int = FREE_DOWNLOAD
+    paid: int = 0
+    quality: Literal["high", "medium", "low", "audio", "custom"] = "high"
+    format: Literal["video", "audio", "document"] = "video"
+    # day of the last free quota top up, see _today
+    reset_day: int = 0
+
+
+# other processes invalidate through Redis only, so the in-process copy must not live long
+PROFILE_LOCAL_TTL = 10
+_profiles: dict[int, tuple[float, UserProfile]] = {}
+_profiles_lock = threading.Lock()
+_redis = Redis()
+
+
+def _load_profile(tgid: int) -> UserProfile:
     with session_manager() as session:
-        user = session.query(User).filter(User.user_id == tgid).first()
-        if user and user.settings:
-            return user.settings.quality
+        row = (
+            session.query(User.free, User.paid, User.config, Setting.quality, Setting.format)
+            .outerjoin(Setting, Setting.user_id == User.id)
+            .filter(User.user_id == tgid)
+            .first()
+        )
+    if row is None:
+        return UserProfile(user_id=tgid)
+    free, paid, config, quality, format_ = row
+    return UserProfile(
+        user_id=tgid,
+        exists=True,
+        free=free,
+        paid=paid,
+        quality=quality or "high",
+        format=format_ or "video",
+        reset_day=(config or {}).get("reset_day", 0),
+    )
+
+
+def get_profile(tgid: int) -> UserProfile:
+    """Read-through: the in-process copy, then Redis, then MySQL."""
+    now = time.monotonic()
+    with _profiles_lock:
+        if (item := _profiles.get(tgid)) and item[0] > now:
+            return item[1]
+
+    if raw := _redis.r.get(f"profile:{tgid}"):
+        profile = UserProfile(**json.loads(raw))
+    else:
+        profile = _load_profile(tgid)
+        _redis.r.set(f"profile:{tgid}", json.dumps(asdict(profile)), ex=PROFILE_CACHE_TTL)
 
-        return "high"
+    with _profiles_lock:
+        _profiles[tgid] = (now + PROFILE_LOCAL_TTL, profile)
+    return profile
+
+
+def invalidate_profile(*tgids: int):
+    with _profiles_lock:
+        for tgid in tgids:
+            _profiles.pop(tgid, None)
+    if tgids:
+        _redis.r.delete(*(f"profile:{tgid}" for tgid in tgids))
+
+
+def get_quality_settings(tgid) -> Literal["high", "medium", "low", "audio", "custom"]:
+    return get_profile(tgid).quality
 
 
 def get_format_settings(tgid) -> Literal["video", "audio", "document"]:
-    with session_manager() as session:
-        user = session.query(User).filter(User.user_id == tgid).first()
-        if user and user.settings:
-            return user.settings.format
-        return "video"
+    return get_profile(tgid).format
 
 
 def set_user_settings(tgid: int, key: str, value: str):
@@ -134,87 +203,247 @@ def set_user_settings(tgid: int, key: str, value: str):
             setattr(setting, key, value)
         else:
             session.add(Setting(user_id=user.id, **{key: value}))
+    invalidate_profile(tgid)
+
+
+def _quota_key(uid: int) -> str:
+    return f"quota:{uid}"
+
+
+# Redis holds the live quota of every user who used the bot since the last restart of Redis,
+# users whose quota changed are collected in QUOTA_DIRTY and written back to MySQL by flush_quota.
+QUOTA_DIRTY = "quota:dirty"
+QUOTA_EXHAUSTED = "Quota exhausted. Please /buy or wait until free quota is reset"
+
+# KEYS: quota hash, dirty set. ARGV: user id, today, daily free quota, then free, paid and reset day to seed
+# the hash with. Returns nil if the hash must be seeded first. The free quota is topped up on the first
+# access of a day, instead of resetting every user at midnight.
+_QUOTA_PRELUDE = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    if #ARGV < 6 then return nil end
+    -- atomic with the check above, a seed never overwrites a hash that exists
+    redis.call('HSETNX', KEYS[1], 'free', ARGV[4])
+    redis.call('HSETNX', KEYS[1], 'paid', ARGV[5])
+    redis.call('HSETNX', KEYS[1], 'day', ARGV[6])
+end
+if tonumber(redis.call('HGET', KEYS[1], 'day') or 0) < tonumber(ARGV[2]) then
+    redis.call('HSET', KEYS[1], 'free', ARGV[3], 'day', ARGV[2])
+    redis.call('SADD', KEYS[2], ARGV[1])
+end
+"""
+
+class _LazyScript:
+    """A Lua script registered with the shared client on its first call."""
+
+    def __init__(self, source: str):
+        self._source = source
+        self._script = None
+
+    def __call__(self, keys: list, args: list):
+        if self._script is None:
+            self._script = _redis.r.register_script(self._source)
+        return self._script(keys=keys, args=args)
+
+
+# returns the bucket that was charged, "" if both are empty
+_spend = _LazyScript(
+    _QUOTA_PRELUDE
+    + """
+for _, bucket in ipairs({'free', 'paid'}) do
+    if tonumber(redis.call('HGET', KEYS[1], bucket)) > 0 then
+        redis.call('HINCRBY', KEYS[1], bucket, -1)
+        redis.call('SADD', KEYS[2], ARGV[1])
+        return bucket
+    end
+end
+return ''
+"""
+)
+
+_peek = _LazyScript(_QUOTA_PRELUDE + "return redis.call('HMGET', KEYS[1], 'free', 'paid')")
+
+
+def _today() -> int:
+    # local days, like the midnight reset this replaces
+    return date.today().toordinal()
+
+
+def _run_quota(script, uid: int):
+    keys, args = [_quota_key(uid), QUOTA_DIRTY], [uid, _today(), FREE_DOWNLOAD]
+    result = script(keys=keys, args=args)
+    if result is None:
+        # not in Redis yet, seed it from MySQL, bypassing the profile cache
+        profile = _load_profile(uid)
+        result = script(keys=keys, args=args + [profile.free, profile.paid, profile.reset_day])
+    return result
+
+
+# KEYS: quota hash, dirty set. ARGV: user id, field, "set" or "incr", value.
+# Users without a hash are left alone, their quota is read from MySQL.
+_adjust = _LazyScript(
+    """
+if redis.call('EXISTS', KEYS[1]) == 0 then return 0 end
+if ARGV[3] == 'set' then
+    redis.call('HSET', KEYS[1], ARGV[2], ARGV[4])
+else
+    redis.call('HINCRBY', KEYS[1], ARGV[2], ARGV[4])
+end
+redis.call('SADD', KEYS[2], ARGV[1])
+return 1
+"""
+)
+
+
+def _seed_quota(uid: int):
+    """
+    Make sure the live quota is in Redis before MySQL is credited. A concurrent job that read MySQL before the
+    credit can't seed its stale copy anymore, the seed only happens while the hash is missing, and the credit
+    is then applied to the hash by _adjust.
+    """
+    _run_quota(_peek, uid)
+
+
+def _quota(uid: int) -> tuple[int, int]:
+    free, paid = _run_quota(_peek, uid)
+    return int(free), int(paid)
 
 
 def get_free_quota(uid: int):
     if not ENABLE_VIP:
         return math.inf
 
-    with session_manager() as session:
-        data = session.query(User).filter(User.user_id == uid).first()
-        if data:
-            return data.free
-        return FREE_DOWNLOAD
+    return _quota(uid)[0]
 
 
 def get_paid_quota(uid: int):
     if ENABLE_VIP:
-        with session_manager() as session:
-            data = session.query(User).filter(User.user_id == uid).first()
-            if data:
-                return data.paid
-
-            return 0
+        return _quota(uid)[1]
 
     return math.inf
 
 
 def reset_free_quota(uid: int):
+    _seed_quota(uid)
     with session_manager() as session:
         data = session.query(User).filter(User.user_id == uid).first()
         if data:
             data.free = 5
+    _adjust(keys=[_quota_key(uid), QUOTA_DIRTY], args=[uid, "free", "set", 5])
+    invalidate_profile(uid)
 
 
 def add_paid_quota(uid: int, amount: int):
+    _seed_quota(uid)
     with session_manager() as session:
         data = session.query(User).filter(User.user_id == uid).first()
         if data:
             data.paid += amount
+    _adjust(keys=[_quota_key(uid), QUOTA_DIRTY], args=[uid, "paid", "incr", amount])
+    invalidate_profile(uid)
 
 
 def check_quota(uid: int):
     if not ENABLE_VIP:
         return
 
-    with session_manager() as session:
-        data = session.query(User).filter(User.user_id == uid).first()
-        if data and (data.free + data.paid) <= 0:
-            raise Exception("Quota exhausted. Please /buy or wait until free quota is reset")
+    free, paid = _quota(uid)
+    if free + paid <= 0:
+        raise Exception(QUOTA_EXHAUSTED)
 
 
-def use_quota(uid: int):
-    # use free first, then paid
+def use_quota(uid: int) -> str | None:
+    """
+    Take one download from the user's quota, free first, then paid. Returns the bucket it was taken from,
+    hand it to refund_quota if the download fails.
+    """
     if not ENABLE_VIP:
-        return
-
-    with session_manager() as session:
-        user = session.query(User).filter(User.user_id == uid).first()
-        if user:
-            if user.free > 0:
-                user.free -= 1
-            elif user.paid > 0:
-                user.paid -= 1
-            else:
-                raise Exception("Quota exhausted. Please /buy or wait until free quota is reset")
+        return None
+
+    bucket = _run_quota(_spend, uid)
+    if not bucket:
+        raise Exception(QUOTA_EXHAUSTED)
+    return bucket
+
+
+def refund_quota(uid: int, bucket: str | None):
+    if bucket:
+        _adjust(keys=[_quota_key(uid), QUOTA_DIRTY], args=[uid, bucket, "incr", 1])
+
+
+def _with_reset_day(config, day):
+    # the reset day lives in the config column, so no migration is needed
+    return func.json_set(func.coalesce(config, "{}"), "$.reset_day", day)
+
+
+def flush_quota(batch: int = 500):
+    """Write the quota changed in Redis back to MySQL, which stays the durable record."""
+    while uids := _redis.r.spop(QUOTA_DIRTY, batch):
+        with _redis.r.pipeline(transaction=False) as pipe:
+            for uid in uids:
+                pipe.hmget(_quota_key(uid), "free", "paid", "day")
+            values = pipe.execute()
+        rows = [
+            {"uid": int(uid), "new_free": int(free), "new_paid": int(paid), "new_day": int(day)}
+            for uid, (free, paid, day) in zip(uids, values)
+            if free is not None
+        ]
+        if not rows:
+            continue
+        try:
+            with session_manager() as session:
+                table = User.__table__
+                stmt = (
+                    update(table)
+                    .where(table.c.user_id == bindparam("uid"))
+                    .values(
+                        free=bindparam("new_free"),
+                        paid=bindparam("new_paid"),
+                        config=_with_reset_day(table.c.config, bindparam("new_day")),
+                    )
+                )
+                session.connection().execute(stmt, rows)
+        except Exception:
+            # try again with the next flush
+            _redis.r.sadd(QUOTA_DIRTY, *uids)
+            raise
+        logging.info("Flushed quota of %s users to MySQL", len(rows))
+        invalidate_profile(*(int(uid) for uid in uids))
 
 
 def init_user(uid: int):
+    # called for nearly every message, known users don't need a query
+    if get_profile(uid).exists:
+        return
     with session_manager() as session:
         user = session.query(User).filter(User.user_id == uid).first()
         if not user:
             session.add(User(user_id=uid))
+    invalidate_profile(uid)
 
 
-def reset_free():
-    with session_manager() as session:
-        users = session.query(User).all()
-        for user in users:
-            user.free = FREE_DOWNLOAD
-        session.commit()
+def reset_free(chunk: int = 1000):
+    """
+    Optional, the free quota is topped up lazily on first use of a day. This only brings MySQL up to date for
+    reporting, with one bulk UPDATE per chunk of users so no lock is held for long.
+    """
+    flush_quota()
+    today, last_id = _today(), 0
+    while True:
+        with session_manager() as session:
+            ids = [i for (i,) in session.query(User.id).filter(User.id > last_id).order_by(User.id).limit(chunk)]
+            if not ids:
+                break
+            # users who were topped up or spent today already are up to date
+            stale = func.coalesce(func.json_extract(User.config, "$.reset_day"), 0) < today
+            session.query(User).filter(User.id.in_(ids), stale).update(
+                {User.free: FREE_DOWNLOAD, User.config: _with_reset_day(User.config, today)},
+                synchronize_session=False,
+            )
+        last_id = ids[-1]
 
 
 def credit_account(who, total_amount: int, quota: int, transaction, method="stripe"):
+    _seed_quota(who)
     with session_manager() as session:
         user = session.query(User).filter(User.user_id == who).first()
         if user:
@@ -231,6 +460,9 @@ def credit_account(who, total_amount: int, quota: int, transaction, method="stri
                 )
             )
             session.commit()
-            return user.free, user.paid
+            # seeded above, so the live quota in Redis gets the credit too
+            _adjust(keys=[_quota_key(who), QUOTA_DIRTY], args=[who, "paid", "incr", quota])
+            invalidate_profile(who)
+            return _quota(who)
 
         return None, None
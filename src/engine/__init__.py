@@ -6,11 +6,15 @@
 from urllib.parse import urlparse
 from typing import Any, Callable
 
+from config import MAX_CONCURRENT_DOWNLOADS, MAX_USER_DOWNLOADS
 from engine.generic import YoutubeDownload
 from engine.direct import DirectDownload
 from engine.pixeldrain import pixeldrain_download
 from engine.instagram import InstagramDownload
 from engine.krakenfiles import krakenfiles_download
+from engine.scheduler import JobScheduler
+
+scheduler = JobScheduler(MAX_CONCURRENT_DOWNLOADS, MAX_USER_DOWNLOADS)
 
 
 def youtube_entrance(client, bot_message, url):
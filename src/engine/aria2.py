@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# ytdlbot - aria2.py
+
+import logging
+import secrets
+import subprocess
+import threading
+import time
+import uuid
+from typing import Callable
+
+import requests
+
+from config import (
+    ARIA2_MAX_CONCURRENT,
+    ARIA2_RPC_PORT,
+    ARIA2_RPC_SECRET,
+    ARIA2_RPC_URL,
+    ARIA2_SPEED_LIMIT,
+)
+from engine.http_client import http_client
+from utils import sizeof_fmt, timeof_fmt
+
+UA = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/138.0.0.0 Safari/537.36"
+STATUS_KEYS = ["gid", "status", "totalLength", "completedLength", "downloadSpeed", "errorMessage", "files"]
+
+
+class Aria2:
+    """
+    One long-lived aria2c daemon per node, driven over JSON-RPC.
+    A single poller thread fetches the status of every active download with one batched `system.multicall`,
+    jobs only wait for their own status to change. Point `rpc_url` to an existing daemon(or a stub) to skip spawning.
+    """
+
+    def __init__(self, rpc_url: str = None, secret: str = None, port: int = 6800):
+        self._rpc_url = rpc_url or f"http://127.0.0.1:{port}/jsonrpc"
+        # .env.example ships ARIA2_RPC_URL empty, which means spawning one as well
+        self._spawn = not rpc_url
+        self._secret = secret or secrets.token_hex(16)
+        self._port = port
+        self._process: subprocess.Popen | None = None
+        self._lock = threading.Lock()
+        self._cond = threading.Condition()
+        # gid -> latest status, None until the first poll
+        self._active: dict[str, dict | None] = {}
+        self._poller: threading.Thread | None = None
+
+    def call(self, method: str, *params):
+        payload = {
+            "jsonrpc": "2.0",
+            "id": uuid.uuid4().hex,
+            "method": method,
+            "params": [f"token:{self._secret}", *params],
+        }
+        if method.startswith("system."):
+            # system.* methods take the token inside each call instead
+            payload["params"] = list(params)
+        resp = http_client.post(self._rpc_url, json=payload, timeout=10).json()
+        if error := resp.get("error"):
+            raise Exception(error.get("message"))
+        return resp["result"]
+
+    def start(self):
+        with self._lock:
+            if self._spawn and (self._process is None or self._process.poll() is not None):
+                self._start_daemon()
+            if self._poller is None or not self._poller.is_alive():
+                self._poller = threading.Thread(target=self._poll, name="aria2-poller", daemon=True)
+                self._poller.start()
+
+    def _start_daemon(self):
+        command = [
+            "aria2c",
+            "--enable-rpc=true",
+            f"--rpc-listen-port={self._port}",
+            f"--rpc-secret={self._secret}",
+            f"--max-concurrent-downloads={ARIA2_MAX_CONCURRENT}",
+            f"--max-overall-download-limit={ARIA2_SPEED_LIMIT}",
+            "--max-tries=3",
+            "--continue=true",
+            "--quiet=true",
+        ]
+        logging.info("Starting aria2 daemon on port %s", self._port)
+        self._process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        for _ in range(50):
+            try:
+                self.call("aria2.getVersion")
+                return
+            except requests.RequestException:
+                time.sleep(0.1)
+        raise Exception("aria2 daemon didn't start")
+
+    def download(self, url: str, directory: str, hook: Callable[[dict], None] = None) -> list[str]:
+        self.start()
+        options = {
+            "dir": directory,
+            "split": "16",
+            "max-connection-per-server": "16",
+            "user-agent": UA,
+        }
+        gid = self.call("aria2.addUri", [url], options)
+        with self._cond:
+            self._active[gid] = None
+            self._cond.notify_all()
+
+        try:
+            while True:
+                with self._cond:
+                    self._cond.wait(timeout=5)
+                    status = self._active[gid]
+                if status is None:
+                    continue
+                if status["status"] == "complete":
+                    return [f["path"] for f in status["files"] if f.get("path")]
+                if status["status"] in ("error", "removed"):
+                    raise Exception(status.get("errorMessage") or f"Download {status['status']}")
+                if hook:
+                    hook(self._to_hook(status))
+        except Exception:
+            # i.e. the hook rejected the file, don't keep downloading it
+            try:
+                self.call("aria2.remove", gid)
+            except Exception:
+                pass
+            raise
+        finally:
+            with self._cond:
+                self._active.pop(gid, None)
+
+    @staticmethod
+    def _to_hook(status: dict) -> dict:
+        total, done = int(status["totalLength"]), int(status["completedLength"])
+        speed = int(status["downloadSpeed"])
+        return {
+            "status": "downloading",
+            "downloaded_bytes": done,
+            "total_bytes": total,
+            "_speed_str": f"{sizeof_fmt(speed)}/s",
+            "_eta_str": (timeof_fmt((total - done) / speed) if speed else "") or "N/A",
+        }
+
+    def _poll(self):
+        while True:
+            with self._cond:
+                while not self._active:
+                    self._cond.wait()
+                gids = list(self._active)
+
+            calls = [
+                {"methodName": "aria2.tellStatus", "params": [f"token:{self._secret}", gid, STATUS_KEYS]}
+                for gid in gids
+            ]
+            try:
+                results = self.call("system.multicall", calls)
+            except Exception as e:
+                logging.error("Failed to poll aria2: %s", e)
+                if self._spawn and self._process.poll() is not None:
+                    # the daemon is gone along with its downloads, fail them so the jobs don't hang
+                    with self._cond:
+                        for gid in gids:
+                            self._active[gid] = {"status": "error", "errorMessage": "aria2 daemon exited"}
+                        self._cond.notify_all()
+                time.sleep(1)
+                continue
+
+            with self._cond:
+                for gid, result in zip(gids, results):
+                    if gid not in self._active:
+                        continue
+                    if isinstance(result, list):
+                        self._active[gid] = result[0]
+                    else:
+                        # the download is gone, i.e. daemon restarted
+                        self._active[gid] = {"status": "error", "errorMessage": result.get("faultString")}
+                self._cond.notify_all()
+            time.sleep(1)
+
+
+aria2 = Aria2(ARIA2_RPC_URL, ARIA2_RPC_SECRET, ARIA2_RPC_PORT)
@@ -3,34 +3,55 @@
 
 # ytdlbot - types.py
 
+import asyncio
 import hashlib
 import json
 import logging
 import re
-import tempfile
 import uuid
 from abc import ABC, abstractmethod
-from io import StringIO
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from types import SimpleNamespace
 from typing import final
 
-import ffmpeg
 import filetype
-from pyrogram import enums, types
-from tqdm import tqdm
+from pyrogram import enums, raw, types, utils
+from pyrogram.errors import FilePartMissing, FloodWait
 
 from config import TG_NORMAL_MAX_SIZE, Types
-from database import Redis
+from database import LeaseBusy, Redis
 from database.model import (
-    check_quota,
-    get_format_settings,
     get_free_quota,
     get_paid_quota,
-    get_quality_settings,
+    get_profile,
+    refund_quota,
     use_quota,
 )
-from engine.helper import debounce, sizeof_fmt
+from engine.governor import delay_queue, governor
+from engine.helper import StagingDirectory, ffmpeg_pool, sizeof_fmt, split_limit, split_video
+from engine.metadata import info_metadata, info_thumbnail, keyframe_thumbnail, media_type, probe_metadata
+from engine.progress import render_progress
+from utils import canonical_url, source_domain
+
+
+INPUT_MEDIA = {
+    "document": types.InputMediaDocument,
+    "audio": types.InputMediaAudio,
+    "video": types.InputMediaVideo,
+    "animation": types.InputMediaAnimation,
+    "photo": types.InputMediaPhoto,
+}
+# metadata each send method takes
+METHOD_FIELDS = {
+    "video": {"caption", "thumb", "duration", "width", "height"},
+    "animation": {"caption", "thumb", "duration", "width", "height"},
+    "audio": {"caption", "thumb", "duration"},
+    "document": {"caption", "thumb"},
+    "photo": {"caption"},
+}
+# parts of a split video uploaded at the same time
+UPLOAD_WORKERS = 4
 
 
 def generate_input_media(file_paths: list, cap: str) -> list:
@@ -51,6 +72,9 @@ def generate_input_media(file_paths: list, cap: str) -> list:
 
 
 class BaseDownloader(ABC):
+    # whether the engine only produces media files, which can be split when they are over the Telegram limit
+    _splittable = False
+
     def __init__(self, client: Types.Client, bot_msg: Types.Message, url: str):
         self._client = client
         self._url = url
@@ -60,82 +84,74 @@ class BaseDownloader(ABC):
             # if in group, we need to find out who send the message
             self._from_user = bot_msg.reply_to_message.from_user.id
         self._id = bot_msg.id
-        self._tempdir = tempfile.TemporaryDirectory(prefix="ytdl-")
         self._bot_msg: Types.Message = bot_msg
         self._redis = Redis()
-        self._quality = get_quality_settings(self._chat_id)
-        self._format = get_format_settings(self._chat_id)
+        profile = get_profile(self._chat_id)
+        self._quality = profile.quality
+        self._format = profile.format
+        self._video_key = None
+        # yt-dlp info dict of the downloaded video, if the engine has one
+        self._info: dict | None = None
+        self._staging: StagingDirectory | None = None
+        # path -> InputFile already uploaded to Telegram, sent without uploading it again
+        self._uploaded: dict[str, raw.base.InputFile] = {}
 
-    def __del__(self):
-        self._tempdir.cleanup()
+    @property
+    def _tempdir(self) -> StagingDirectory:
+        # created on first use, jobs served from cache never touch the disk
+        if self._staging is None:
+            self._staging = StagingDirectory(self._video_key or self._calc_video_key())
+        return self._staging
 
-    def _record_usage(self):
-        free, paid = get_free_quota(self._from_user), get_paid_quota(self._from_user)
-        logging.info("User %s has %s free and %s paid quota", self._from_user, free, paid)
-        if free + paid < 0:
-            raise Exception("Usage limit exceeded")
+    @property
+    def _max_size(self) -> int:
+        return split_limit() if self._splittable else TG_NORMAL_MAX_SIZE
 
-        use_quota(self._from_user)
+    def _record_usage(self) -> str | None:
+        bucket = use_quota(self._from_user)
+        free, paid = get_free_quota(self._from_user), get_paid_quota(self._from_user)
+        logging.info("User %s has %s free and %s paid quota left", self._from_user, free, paid)
+        return bucket
 
     @staticmethod
     def __remove_bash_color(text):
         return re.sub(r"\u001b|\[0;94m|\u001b\[0m|\[0;32m|\[0m|\[0;33m", "", text)
 
-    @staticmethod
-    def __tqdm_progress(desc, total, finished, speed="", eta=""):
-        def more(title, initial):
-            if initial:
-                return f"{title} {initial}"
-            else:
-                return ""
-
-        f = StringIO()
-        tqdm(
-            total=total,
-            initial=finished,
-            file=f,
-            ascii=False,
-            unit_scale=True,
-            ncols=30,
-            bar_format="{l_bar}{bar} |{n_fmt}/{total_fmt} ",
-        )
-        raw_output = f.getvalue()
-        tqdm_output = raw_output.split("|")
-        progress = f"`[{tqdm_output[1]}]`"
-        detail = tqdm_output[2].replace("[A", "")
-        text = f"""
-    {desc}
-
-    {progress}
-    {detail}
-    {more("Speed:", speed)}
-    {more("ETA:", eta)}
-        """
-        f.close()
-        return text
-
     def download_hook(self, d: dict):
         if d["status"] == "downloading":
             downloaded = d.get("downloaded_bytes", 0)
             total = d.get("total_bytes") or d.get("total_bytes_estimate", 0)
 
-            if total > TG_NORMAL_MAX_SIZE:
+            if total > self._max_size:
                 msg = f"Your download file size {sizeof_fmt(total)} is too large for Telegram."
                 raise Exception(msg)
 
+            if not governor.due(self._bot_msg):
+                # the edit would be superseded before it's sent, don't bother rendering it
+                return
             # percent = remove_bash_color(d.get("_percent_str", "N/A"))
             speed = self.__remove_bash_color(d.get("_speed_str", "N/A"))
             eta = self.__remove_bash_color(d.get("_eta_str", d.get("eta")))
-            text = self.__tqdm_progress("Downloading...", total, downloaded, speed, eta)
+            text = render_progress("Downloading...", total, downloaded, speed, eta)
             self.edit_text(text)
 
     def upload_hook(self, current, total):
-        text = self.__tqdm_progress("Uploading...", total, current)
+        if not governor.due(self._bot_msg):
+            return
+        text = render_progress("Uploading...", total, current)
         self.edit_text(text)
 
-    @debounce(5)
     def edit_text(self, text: str):
-        self._bot_msg.edit_text(text)
+        # progress only, the governor decides when it is sent and drops it if a newer one comes first
+        governor.update(self._bot_msg, text)
+
+    def edit_final(self, text: str):
+        # pending progress must not land after this text
+        governor.finish(self._bot_msg)
+        try:
+            self._bot_msg.edit_text(text)
+        except FloodWait as e:
+            delay_queue.defer(e.value, self._bot_msg.edit_text, text)
 
     @abstractmethod
     def _setup_formats(self) -> list | None:
@@ -157,11 +173,17 @@ class BaseDownloader(ABC):
         }
 
     def send_something(self, *, chat_id, files, _type, caption=None, thumb=None, **kwargs):
+        # a media group returns all of its messages, a single file its message
         self._client.send_chat_action(chat_id, enums.ChatAction.UPLOAD_DOCUMENT)
         is_cache = kwargs.pop("cache", False)
         if len(files) > 1 and is_cache == False:
             inputs = generate_input_media(files, caption)
-            return self._client.send_media_group(chat_id, inputs)[0]
+            return self._client.send_media_group(chat_id, inputs)
+        elif len(files) > 1:
+            # legacy cache entries of split videos, all parts with the same type
+            inputs = [INPUT_MEDIA[_type](media=file_id) for file_id in files]
+            inputs[0].caption = caption
+            return self._client.send_media_group(chat_id, inputs)
         else:
             file_arg_name = None
             if _type == "photo":
@@ -178,6 +200,9 @@ class BaseDownloader(ABC):
                 logging.error("Unknown _type encountered: %s", _type)
                 return None
 
+            if (file := self._uploaded.get(str(files[0]))) is not None:
+                return self.send_uploaded(chat_id, file, str(files[0]), _type, caption=caption, thumb=thumb, **kwargs)
+
             send_args = {
                 "chat_id": chat_id,
                 file_arg_name: files[0],
@@ -191,37 +216,144 @@ class BaseDownloader(ABC):
 
             return self._methods[_type](**send_args)
 
+    def _run(self, coro):
+        # pyrogram only sync-wraps its public methods, private coroutines must run on the client's loop
+        return asyncio.run_coroutine_threadsafe(coro, self._client.loop).result()
+
+    def send_uploaded(
+        self,
+        chat_id: int,
+        file: raw.base.InputFile,
+        path: str,
+        _type: str,
+        *,
+        caption: str = None,
+        thumb: str = None,
+        duration: int = 0,
+        width: int = 0,
+        height: int = 0,
+        **kwargs,
+    ) -> Types.Message:
+        """Send a file that is already on Telegram's servers, like send_video and friends do after save_file."""
+        thumb = self._client.save_file(thumb) if thumb and _type != "photo" else None
+        media = self._input_media(file, path, _type, thumb, duration, width, height)
+        while True:
+            try:
+                r = self._client.invoke(
+                    raw.functions.messages.SendMedia(
+                        peer=self._client.resolve_peer(chat_id),
+                        media=media,
+                        random_id=self._client.rnd_id(),
+                        **self._run(utils.parse_text_entities(self._client, caption, None, None)),
+                    )
+                )
+            except FilePartMissing as e:
+                self._client.save_file(path, file_id=file.id, file_part=e.value)
+            else:
+                return self._run(utils.parse_messages(client=self._client, messages=r))[0]
+
+    def _input_media(self, file, path, _type, thumb=None, duration=0, width=0, height=0) -> raw.base.InputMedia:
+        # thumb is an uploaded InputFile, so parts of a split video can share one
+        name = Path(path).name
+        if _type == "photo":
+            return raw.types.InputMediaUploadedPhoto(file=file)
+
+        attributes = [raw.types.DocumentAttributeFilename(file_name=name)]
+        if _type in ("video", "animation"):
+            attributes.append(
+                raw.types.DocumentAttributeVideo(supports_streaming=True, duration=duration, w=width, h=height)
+            )
+        if _type == "animation":
+            attributes.append(raw.types.DocumentAttributeAnimated())
+        if _type == "audio":
+            attributes.append(raw.types.DocumentAttributeAudio(duration=duration))
+        return raw.types.InputMediaUploadedDocument(
+            mime_type=self._client.guess_mime_type(name) or "application/zip",
+            file=file,
+            force_file=_type == "document" or None,
+            thumb=thumb,
+            attributes=attributes,
+        )
+
+    def send_group(self, chat_id: int, files: list, _type: str, *, caption=None, thumb=None, **kwargs) -> list:
+        """Upload the files concurrently and send them as one media group, in the given order."""
+        peer = self._client.resolve_peer(chat_id)
+        sizes = [Path(f).stat().st_size for f in files]
+        progress = [0] * len(files)
+        # probed through the shared pool like every other ffmpeg job, while the parts upload
+        probes = [ffmpeg_pool.submit(probe_metadata, str(f)) for f in files]
+        # every part of a split video has the same thumbnail, upload it once
+        thumb = self._client.save_file(thumb) if thumb and _type != "photo" else None
+
+        def upload(index: int, path: str) -> raw.base.InputMedia:
+            def hook(current, _):
+                progress[index] = current
+                self.upload_hook(sum(progress), sum(sizes))
+
+            file = self._client.save_file(path, progress=hook)
+            duration = probes[index].result().get("duration") or kwargs.get("duration", 0)
+            media = self._input_media(
+                file, path, _type, thumb, duration, kwargs.get("width", 0), kwargs.get("height", 0)
+            )
+            # media groups only take media that is already stored on Telegram's side
+            r = self._client.invoke(raw.functions.messages.UploadMedia(peer=peer, media=media))
+            if _type == "photo":
+                return raw.types.InputMediaPhoto(
+                    id=raw.types.InputPhoto(
+                        id=r.photo.id, access_hash=r.photo.access_hash, file_reference=r.photo.file_reference
+                    )
+                )
+            return raw.types.InputMediaDocument(
+                id=raw.types.InputDocument(
+                    id=r.document.id, access_hash=r.document.access_hash, file_reference=r.document.file_reference
+                )
+            )
+
+        with ThreadPoolExecutor(min(len(files), UPLOAD_WORKERS)) as pool:
+            medias = list(pool.map(upload, range(len(files)), [str(f) for f in files]))
+
+        multi_media = [
+            raw.types.InputSingleMedia(
+                media=media,
+                random_id=self._client.rnd_id(),
+                **self._run(utils.parse_text_entities(self._client, caption if i == 0 else "", None, None)),
+            )
+            for i, media in enumerate(medias)
+        ]
+        r = self._client.invoke(raw.functions.messages.SendMultiMedia(peer=peer, multi_media=multi_media))
+        return self._run(utils.parse_messages(client=self._client, messages=r))
+
     def get_metadata(self):
         video_path = list(Path(self._tempdir.name).glob("*"))[0]
         filename = Path(video_path).name
-        width = height = duration = 0
-        try:
-            video_streams = ffmpeg.probe(video_path, select_streams="v")
-            for item in video_streams.get("streams", []):
-                height = item["height"]
-                width = item["width"]
-            duration = int(float(video_streams["format"]["duration"]))
-        except Exception as e:
-            logging.error("Error while getting metadata: %s", e)
-        try:
-            thumb = Path(video_path).parent.joinpath(f"{uuid.uuid4().hex}-thunmnail.png").as_posix()
-            # A thumbnail's width and height should not exceed 320 pixels.
-            ffmpeg.input(video_path, ss=duration / 2).filter(
-                "scale",
-                "if(gt(iw,ih),300,-1)",  # If width > height, scale width to 320 and height auto
-                "if(gt(iw,ih),-1,300)",
-            ).output(thumb, vframes=1).run()
-        except ffmpeg._run.Error:
-            thumb = None
+        _type = media_type(video_path, self._info)
+        audio_only = self._format == "audio" or _type == "audio"
+        # yt-dlp already knows most of it, only probe the file for what's missing
+        meta = info_metadata(self._info)
+        required = ("duration",) if audio_only else ("width", "height", "duration")
+        if not all(meta.get(k) for k in required):
+            meta = {**probe_metadata(video_path), **meta}
+        width, height, duration = meta.get("width", 0), meta.get("height", 0), meta.get("duration", 0)
+
+        thumb = Path(video_path).parent.joinpath(f"{uuid.uuid4().hex}-thumbnail.jpg")
+        thumb = info_thumbnail(self._info, thumb) or (
+            None if audio_only else keyframe_thumbnail(video_path, duration, thumb)
+        )
 
         caption = f"{self._url}\n{filename}\n\nResolution: {width}x{height}\nDuration: {duration} seconds"
-        return dict(height=height, width=width, duration=duration, thumb=thumb, caption=caption)
+        return dict(height=height, width=width, duration=duration, thumb=thumb, caption=caption, type=_type)
 
     def _upload(self, files=None, meta=None):
         if files is None:
             files = list(Path(self._tempdir.name).glob("*"))
         if meta is None:
-            meta = self.get_metadata()
+            # probe and thumbnail run next to the upload, only the final send has to wait for them
+            pending = ffmpeg_pool.submit(self.get_metadata)
+            if len(files) == 1 and Path(files[0]).stat().st_size <= TG_NORMAL_MAX_SIZE:
+                self._save_file(files[0])
+            meta = pending.result()
+        if not meta.get("cache") and any(Path(f).stat().st_size > TG_NORMAL_MAX_SIZE for f in files):
+            return self._upload_parts(files, meta)
 
         success = SimpleNamespace(document=None, video=None, audio=None, animation=None, photo=None)
         if self._format == "document":
@@ -251,85 +383,176 @@ class BaseDownloader(ABC):
                 caption=meta.get("caption"),
             )
         elif self._format == "video":
-            logging.info("Sending as video for %s", self._url)
-            attempt_methods = ["video", "animation", "audio", "photo"]
-            video_meta = meta.copy()
-
-            upload_successful = False  # Flag to track if any method succeeded
-            for method in attempt_methods:
-                current_meta = video_meta.copy()
-
-                if method == "photo":
-                    current_meta.pop("thumb", None)
-                    current_meta.pop("duration", None)
-                    current_meta.pop("height", None)
-                    current_meta.pop("width", None)
-                elif method == "audio":
-                    current_meta.pop("height", None)
-                    current_meta.pop("width", None)
+            if meta.get("cache") and "type" not in meta:
+                # entries cached before the type was recorded, trying a file_id costs no upload
+                methods = ["video", "animation", "audio", "photo"]
+            else:
+                # picked from the streams of the file, which was uploaded once already. document takes anything
+                methods = list(dict.fromkeys([meta.get("type") or "video", "document"]))
 
+            for method in methods:
+                logging.info("Sending as %s for %s", method, self._url)
+                current_meta = {k: v for k, v in meta.items() if k in METHOD_FIELDS[method]}
                 try:
-                    success_obj = self.send_something(
-                        chat_id=self._chat_id,
-                        files=files,
-                        _type=method,
-                        **current_meta
+                    success = self.send_something(
+                        chat_id=self._chat_id, files=files, _type=method, cache=meta.get("cache", False), **current_meta
                     )
-
-                    if method == "video":
-                        success = success_obj
-                    elif method == "animation":
-                        success = success_obj
-                    elif method == "photo":
-                        success = success_obj
-                    elif method == "audio":
-                        success = success_obj
-
-                    upload_successful = True # Set flag to True on success
+                    meta["type"] = method
                     break
+                except FloodWait:
+                    # another method won't help, the whole job is parked and retried
+                    raise
                 except Exception as e:
                     logging.error("Retry to send as %s, error: %s", method, e)
-
-            # Check the flag after the loop
-            if not upload_successful:
+            else:
                 raise ValueError("ERROR: For direct links, try again with `/direct`.")
 
         else:
             logging.error("Unknown upload format settings for %s", self._format)
             return
 
-        video_key = self._calc_video_key()
-        obj = success.document or success.video or success.audio or success.animation or success.photo
+        messages = success if isinstance(success, list) else [success]
+        self._save_cache(messages, meta)
+        # change progress bar to done
+        self.edit_final("✅ Success")
+        return messages[0]
+
+    def _save_file(self, path):
+        if str(path) in self._uploaded:
+            # i.e. streamed while downloading
+            return
+        # pyrogram logs upload errors and returns None, the send methods will upload it again then
+        if (file := self._client.save_file(str(path), progress=self.upload_hook)) is not None:
+            self._uploaded[str(path)] = file
+
+    def _upload_parts(self, files: list, meta: dict):
+        parts = []
+        for file in files:
+            if Path(file).stat().st_size > TG_NORMAL_MAX_SIZE:
+                self.edit_final("The file is over the Telegram limit, splitting it into parts...")
+                parts.extend(ffmpeg_pool.submit(split_video, file).result())
+            else:
+                parts.append(file)
+
+        kwargs = {k: v for k, v in meta.items() if k not in ("caption", "thumb", "type")}
+        _type = self._format if self._format in ("video", "audio") else "document"
+        messages = None
+        for method in dict.fromkeys([_type, "document"]):
+            logging.info("Sending %s parts as %s for %s", len(parts), method, self._url)
+            try:
+                messages = self.send_group(
+                    self._chat_id, parts, method, caption=meta.get("caption"), thumb=meta.get("thumb"), **kwargs
+                )
+                meta["type"] = method
+                break
+            except FloodWait:
+                raise
+            except Exception as e:
+                logging.error("Retry to send parts as %s, error: %s", method, e)
+        if messages is None:
+            raise ValueError("ERROR: Failed to send the parts of your file.")
+
+        self._save_cache(messages, meta)
+        self.edit_final("✅ Success")
+        return messages[0]
+
+    def _save_cache(self, messages: list, meta: dict):
+        # every message of a group is cached in order, so the next request gets all of them
+        items = []
+        for message in filter(None, messages):
+            _type = message.media.value if getattr(message, "media", None) else None
+            obj = getattr(message, _type, None) if _type else None
+            items.append({"file_id": getattr(obj, "file_id", None), "type": _type, "caption": message.caption or ""})
+        video_key = self._video_key or self._calc_video_key()
         mapping = {
-            "file_id": json.dumps([getattr(obj, "file_id", None)]),
+            "items": json.dumps(items, ensure_ascii=False),
+            # read by older versions sharing the cache
+            "file_id": json.dumps([item["file_id"] for item in items]),
             "meta": json.dumps({k: v for k, v in meta.items() if k != "thumb"}, ensure_ascii=False),
         }
-
-        self._redis.add_cache(video_key, mapping)
-        # change progress bar to done
-        self._bot_msg.edit_text("✅ Success")
-        return success
+        self._redis.add_cache(video_key, mapping, source_domain(self._url))
+
+    def _send_cached(self, items: list[dict]):
+        """Send a cached entry again by file_id, a group is rebuilt item by item with its own type and caption."""
+        self._client.send_chat_action(self._chat_id, enums.ChatAction.UPLOAD_DOCUMENT)
+        if len(items) == 1:
+            item = items[0]
+            self._methods[item["type"]](
+                chat_id=self._chat_id, **{item["type"]: item["file_id"]}, caption=item["caption"]
+            )
+        else:
+            inputs = [INPUT_MEDIA[item["type"]](media=item["file_id"], caption=item["caption"]) for item in items]
+            self._client.send_media_group(self._chat_id, inputs)
+        self.edit_final("✅ Success")
 
     def _get_video_cache(self):
-        return self._redis.get_cache(self._calc_video_key())
+        key = self._video_key or self._calc_video_key()
+        domain = source_domain(self._url)
+        cache, legacy = self._redis.get_caches(key, self._calc_legacy_key(), domain=domain)
+        if cache:
+            return cache
+        # entries cached before canonicalization are keyed by the raw URL, copy them over on first use
+        if cache := legacy:
+            logging.info("Migrating legacy cache entry for %s", self._url)
+            self._redis.add_cache(key, cache, domain)
+        return cache
+
+    def _canonical_url(self) -> str:
+        return canonical_url(self._url)
 
     def _calc_video_key(self):
         h = hashlib.md5()
-        h.update((self._url + self._quality + self._format).encode())
+        h.update((self._canonical_url() + self._quality + self._format).encode())
         key = h.hexdigest()
         return key
 
+    def _calc_legacy_key(self):
+        h = hashlib.md5()
+        h.update((self._url + self._quality + self._format).encode())
+        return h.hexdigest()
+
     @final
     def start(self):
-        check_quota(self._from_user)
-        if cache := self._get_video_cache():
+        # reserved before anything is downloaded, so parallel jobs can't both spend the last download
+        bucket = self._record_usage()
+        try:
+            self._serve()
+        except BaseException:
+            refund_quota(self._from_user, bucket)
+            raise
+
+    def _serve(self):
+        # the same video is only fetched once at a time, concurrent requests are parked and then use the cache.
+        # engines may change self._format while downloading, so keep the key we started with
+        key = self._video_key = self._calc_video_key()
+        if not (cache := self._get_video_cache()):
+            with self._redis.lease(key) as acquired:
+                if not acquired:
+                    # frees the worker, the caller resubmits the job once the lease is released
+                    raise LeaseBusy(key)
+                # the previous holder might have just filled the cache
+                if not (cache := self._get_video_cache()):
+                    try:
+                        self._start()
+                    except FloodWait:
+                        # the job is parked and retried later, keep what was downloaded for it
+                        self._staging = None
+                        raise
+                    finally:
+                        # still under the lease, so the next holder can't be using this directory yet
+                        if self._staging is not None:
+                            self._staging.cleanup()
+
+        if cache:
             logging.info("Cache hit for %s", self._url)
-            meta, file_id = json.loads(cache["meta"]), json.loads(cache["file_id"])
-            meta["cache"] = True
-            self._upload(file_id, meta)
-        else:
-            self._start()
-        self._record_usage()
+            items = json.loads(cache.get("items", "[]"))
+            if items and all(item["file_id"] and item["type"] in INPUT_MEDIA for item in items):
+                self._send_cached(items)
+            else:
+                # entries cached before every item was recorded with its type
+                meta, file_id = json.loads(cache["meta"]), json.loads(cache["file_id"])
+                meta["cache"] = True
+                self._upload(file_id, meta)
 
     @abstractmethod
     def _start(self):
@@ -3,17 +3,22 @@
 
 # ytdlbot - generic.py
 
+import copy
 import logging
 import os
 from pathlib import Path
 
 import yt_dlp
 
-from config import AUDIO_FORMAT
-from utils import is_youtube
-from database.model import get_format_settings, get_quality_settings
+from config import AUDIO_FORMAT, TG_NORMAL_MAX_SIZE
+from utils import is_youtube, sizeof_fmt
+from database import InfoCache
 from engine.base import BaseDownloader
 
+info_cache = InfoCache()
+# lower rungs to try when the preferred formats are too large for Telegram
+FALLBACK_HEIGHTS = (1080, 720, 480, 360, 240, 144)
+
 
 def match_filter(info_dict):
     if info_dict.get("is_live"):
@@ -21,7 +26,22 @@ def match_filter(info_dict):
     return None  # Allow download for non-live videos
 
 
+def estimate_size(info: dict) -> int | None:
+    # yt-dlp fills filesize_approx from bitrate and duration when the site doesn't tell the size
+    total = 0
+    for f in info.get("requested_formats") or [info]:
+        size = f.get("filesize") or f.get("filesize_approx")
+        if not size and f.get("tbr") and info.get("duration"):
+            size = f["tbr"] * 1000 / 8 * info["duration"]
+        if not size:
+            return None
+        total += size
+    return int(total)
+
+
 class YoutubeDownload(BaseDownloader):
+    _splittable = True
+
     @staticmethod
     def get_format(m):
         return [
@@ -33,7 +53,7 @@ class YoutubeDownload(BaseDownloader):
         if not is_youtube(self._url):
             return [None]
 
-        quality, format_ = get_quality_settings(self._chat_id), get_format_settings(self._chat_id)
+        quality, format_ = self._quality, self._format
         # quality: high, medium, low, custom
         # format: audio, video, document
         formats = []
@@ -123,16 +143,74 @@ class YoutubeDownload(BaseDownloader):
             # Always use the `source` format for Google Drive URLs.
             formats = ["source"] + formats
 
-        files = None
-        for f in formats:
-            ydl_opts["format"] = f
-            logging.info("yt-dlp options: %s", ydl_opts)
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                ydl.download([self._url])
-            files = list(Path(self._tempdir.name).glob("*"))
-            break
-
-        return files
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            info = self._extract_info(ydl)
+        ydl_opts["format"] = self._plan_format(ydl_opts, info, formats)
+        logging.info("yt-dlp options: %s", ydl_opts)
+        # yt-dlp continues from the .part files in the staging directory if a previous run was interrupted
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            self._info = ydl.process_ie_result(info, download=True)
+
+        files = {Path(i["filepath"]).resolve() for i in self._info.get("requested_downloads", []) if i.get("filepath")}
+        if files:
+            # the interrupted run might have picked another format, don't upload its leftovers
+            for item in Path(self._tempdir.name).glob("*"):
+                if item.resolve() not in files:
+                    item.unlink()
+        return list(Path(self._tempdir.name).glob("*"))
+
+    def _plan_format(self, ydl_opts: dict, info: dict, formats: list) -> str | None:
+        # resolve the preferred formats to a concrete one that fits into Telegram, before any bytes are downloaded
+        candidates = list(formats)
+        if self._format != "audio":
+            candidates.extend(f"bv*[height<={h}]+ba/b[height<={h}]" for h in FALLBACK_HEIGHTS)
+
+        too_large, error = [], None
+        for spec in candidates:
+            with yt_dlp.YoutubeDL({**ydl_opts, "format": spec}) as ydl:
+                try:
+                    planned = ydl.process_ie_result(copy.deepcopy(info), download=False)
+                except (yt_dlp.utils.DownloadError, yt_dlp.utils.ExtractorError) as e:
+                    logging.info("Format %s is not available for %s", spec, self._url)
+                    error = e
+                    continue
+
+            format_id, size = planned.get("format_id") or spec, estimate_size(planned)
+            if size is None or size <= TG_NORMAL_MAX_SIZE:
+                logging.info("Planned format %s, about %s for %s", format_id, sizeof_fmt(size or 0), self._url)
+                return format_id
+            logging.info("Format %s doesn't fit into one upload: %s", format_id, sizeof_fmt(size))
+            too_large.append((format_id, size))
+
+        # a lower quality in one piece beats a higher one in parts, splitting is the last resort
+        for format_id, size in too_large:
+            if size <= self._max_size:
+                logging.info("Planned format %s, about %s in parts for %s", format_id, sizeof_fmt(size), self._url)
+                return format_id
+        if too_large:
+            smallest = sizeof_fmt(min(size for _, size in too_large))
+            raise ValueError(f"Your video is too large for Telegram, the smallest format is about {smallest}.")
+        if error is not None:
+            raise error
+        raise ValueError(f"No format to download for {self._url}")
+
+    def _extract_info(self, ydl: yt_dlp.YoutubeDL) -> dict:
+        # extraction is the expensive part(webpage, player js, signatures), share one result across retries and jobs
+        key = self._canonical_url()
+        if info := info_cache.get(key):
+            logging.info("Info cache hit for %s", self._url)
+            return info
+
+        info = ydl.extract_info(self._url, download=False, process=False)
+        # comment extractors and lazy fragment lists are functions, such results can't be serialized
+        if any(callable(v) for item in [info, *(info.get("formats") or [])] for v in item.values()):
+            return info
+        # neither can lazy playlist entries, sanitize_info would turn the generator into its repr
+        if not isinstance(info.get("entries") or [], list):
+            return info
+        info = ydl.sanitize_info(info)
+        info_cache.set(key, info)
+        return info
 
     def _start(self, formats=None):
         # start download and upload, no cache hit
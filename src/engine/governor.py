@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# ytdlbot - governor.py
+
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable
+
+import token_bucket
+from pyrogram.errors import FloodWait, MessageNotModified
+
+from config import EDIT_CHAT_RATE, EDIT_GLOBAL_RATE, EDIT_INTERVAL, Types
+
+GLOBAL = "global"
+# messages whose job never called finish, i.e. the worker crashed
+STALE_AFTER = 3600
+
+
+class ExpiringStorage(token_bucket.MemoryStorage):
+    def evict(self, max_idle: float):
+        # a bucket idle this long has refilled completely, dropping it changes nothing
+        now = time.monotonic()
+        for key in [k for k, (_, last) in list(self._buckets.items()) if now - last > max_idle]:
+            self._buckets.pop(key, None)
+
+    def refund(self, key: str, num_tokens: int = 1):
+        # capped at the capacity again by the next replenish
+        if bucket := self._buckets.get(key):
+            bucket[0] += num_tokens
+
+
+class EditGovernor:
+    """
+    The only way progress edits reach Telegram.
+
+    Callers hand in the latest text of a message and return immediately, a background thread sends it later.
+    Only the newest text per message is kept, older ones are dropped without being sent. A message is edited
+    at most once every `interval` seconds, and every edit takes a token from its chat's bucket and from the
+    global bucket. Jobs call `finish` before their final edit, so a late progress update can't overwrite it.
+    """
+
+    def __init__(self, rate: int = 20, chat_rate: int = 20, interval: int = 5):
+        self._interval = interval
+        self._storage = ExpiringStorage()
+        self._global = token_bucket.Limiter(rate, max(1, rate), self._storage)
+        # chat_rate is per minute, like Telegram's group limit
+        self._chat = token_bucket.Limiter(chat_rate / 60, max(1, chat_rate // 4), self._storage)
+        self._chat_idle = max(1, chat_rate // 4) / (chat_rate / 60)
+        # (chat id, message id) -> (message, text)
+        self._pending: OrderedDict[tuple, tuple[Types.Message, str]] = OrderedDict()
+        self._last_sent: dict[tuple, float] = {}
+        self._held: dict[int, float] = {}
+        self._inflight: set[tuple] = set()
+        self._cond = threading.Condition()
+        self._sent = self._dropped = 0
+        self._thread: threading.Thread | None = None
+
+    @staticmethod
+    def _key(message: Types.Message) -> tuple:
+        return message.chat.id, message.id
+
+    def due(self, message: Types.Message) -> bool:
+        """Whether an update for this message would be sent soon, otherwise it will most likely be superseded."""
+        return time.monotonic() - self._last_sent.get(self._key(message), 0) >= self._interval
+
+    def update(self, message: Types.Message, text: str):
+        key = self._key(message)
+        with self._cond:
+            if key in self._pending:
+                self._dropped += 1
+            self._pending[key] = (message, text)
+            self._cond.notify_all()
+        self._start()
+
+    def finish(self, message: Types.Message):
+        """Forget the message, waiting for an edit of it that is on the wire right now."""
+        key = self._key(message)
+        with self._cond:
+            self._pending.pop(key, None)
+            self._last_sent.pop(key, None)
+            while key in self._inflight:
+                self._cond.wait()
+
+    def stats(self) -> dict:
+        with self._cond:
+            now = time.monotonic()
+            return {
+                "pending": len(self._pending),
+                "tracked": len(self._last_sent),
+                "held": sum(1 for until in self._held.values() if until > now),
+                "sent": self._sent,
+                "dropped": self._dropped,
+            }
+
+    def _start(self):
+        if self._thread is None:
+            with self._cond:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="edit-governor", daemon=True)
+                    self._thread.start()
+
+    def _next(self) -> tuple | None:
+        now = time.monotonic()
+        for key in self._pending:
+            chat_id = key[0]
+            if key in self._inflight or now - self._last_sent.get(key, 0) < self._interval:
+                continue
+            if self._held.get(chat_id, 0) > now or not self._chat.consume(f"chat:{chat_id}"):
+                continue
+            if not self._global.consume(GLOBAL):
+                # nothing else can go out either, the chat keeps its token for when this edit is sent
+                self._storage.refund(f"chat:{chat_id}")
+                return None
+            return key
+        return None
+
+    def _sweep(self):
+        now = time.monotonic()
+        for key in [k for k, sent in self._last_sent.items() if now - sent > STALE_AFTER]:
+            del self._last_sent[key]
+        for chat_id in [c for c, until in self._held.items() if until <= now]:
+            del self._held[chat_id]
+        self._storage.evict(self._chat_idle)
+
+    def _run(self):
+        swept = time.monotonic()
+        while True:
+            with self._cond:
+                while (key := self._next()) is None:
+                    # idle until update() notifies, pending edits wait for their interval or a token
+                    self._cond.wait(timeout=0.2 if self._pending else None)
+                    if time.monotonic() - swept > 60:
+                        self._sweep()
+                        swept = time.monotonic()
+                message, text = self._pending.pop(key)
+                self._inflight.add(key)
+                self._last_sent[key] = time.monotonic()
+
+            sent = False
+            try:
+                message.edit_text(text)
+                sent = True
+            except MessageNotModified:
+                pass
+            except FloodWait as e:
+                logging.warning("Flood wait %s seconds for edits in chat %s", e.value, key[0])
+                with self._cond:
+                    self._held[key[0]] = time.monotonic() + e.value
+                    # retry later, unless a newer text came in meanwhile
+                    if key in self._last_sent:
+                        self._pending.setdefault(key, (message, text))
+            except Exception as e:
+                logging.warning("Failed to edit message %s: %s", key, e)
+            finally:
+                with self._cond:
+                    self._sent += sent
+                    self._inflight.discard(key)
+                    self._cond.notify_all()
+
+
+class DelayQueue:
+    """
+    Outbound calls that hit a FloodWait, parked until their deadline instead of sleeping on a worker thread.
+    A call that floods again is parked again with the new deadline.
+    """
+
+    def __init__(self):
+        self._heap: list[tuple[float, int, str, Callable[..., Any], tuple, dict]] = []
+        self._cond = threading.Condition()
+        self._counter = itertools.count()
+        self._thread: threading.Thread | None = None
+
+    def defer(self, seconds: float, func: Callable[..., Any], *args, **kwargs):
+        name = getattr(func, "__name__", repr(func))
+        logging.info("Parking %s for %s seconds", name, seconds)
+        with self._cond:
+            heapq.heappush(self._heap, (time.monotonic() + seconds, next(self._counter), name, func, args, kwargs))
+            self._cond.notify()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="delay-queue", daemon=True)
+                self._thread.start()
+
+    def stats(self) -> dict:
+        with self._cond:
+            deadline = self._heap[0][0] - time.monotonic() if self._heap else 0
+            return {"parked": len(self._heap), "next": max(0, int(deadline))}
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    self._cond.wait(timeout=self._heap[0][0] - time.monotonic() if self._heap else None)
+                _, _, name, func, args, kwargs = heapq.heappop(self._heap)
+            try:
+                func(*args, **kwargs)
+            except FloodWait as e:
+                self.defer(e.value, func, *args, **kwargs)
+            except Exception:
+                logging.error("Parked call %s failed", name, exc_info=True)
+
+
+governor = EditGovernor(EDIT_GLOBAL_RATE, EDIT_CHAT_RATE, EDIT_INTERVAL)
+delay_queue = DelayQueue()
@@ -3,14 +3,15 @@
 
 # ytdlbot - helper.py
 
-import functools
 import logging
 import os
 import pathlib
 import re
+import shutil
 import subprocess
-import threading
+import tempfile
 import time
+from concurrent.futures import ThreadPoolExecutor
 from http import HTTPStatus
 from io import StringIO
 
@@ -28,38 +29,43 @@ from config import (
     AUDIO_FORMAT,
     CAPTION_URL_LENGTH_LIMIT,
     ENABLE_ARIA2,
+    FFMPEG_WORKERS,
+    SPLIT_MAX_PARTS,
     TG_NORMAL_MAX_SIZE,
+    TMPFILE_PATH,
 )
 from utils import shorten_url, sizeof_fmt
 
 
-def debounce(wait_seconds):
-    """
-    Thread-safe debounce decorator for functions that take a message with chat.id and msg.id attributes.
-    The function will only be called if it hasn't been called with the same chat.id and msg.id in the last 'wait_seconds'.
-    """
+STAGING_ROOT = pathlib.Path(TMPFILE_PATH or tempfile.gettempdir(), "staging")
 
-    def decorator(func):
-        last_called = {}
-        lock = threading.Lock()
 
-        @functools.wraps(func)
-        def wrapper(*args, **kwargs):
-            nonlocal last_called
-            now = time.time()
+class StagingDirectory:
+    """
+    Persistent working directory of a download, named after its cache key.
+    A job re-queued after a restart lands in the same place and can continue from the partial files of the last run.
+    Engines keep their resume state in `state`, next to the directory so it's never picked up as a downloaded file.
+    """
 
-            # Assuming the first argument is the message object with chat.id and msg.id
-            bot_msg = args[0]._bot_msg
-            key = (bot_msg.chat.id, bot_msg.id)
+    def __init__(self, key: str):
+        self.name = STAGING_ROOT.joinpath(key).as_posix()
+        self.state = STAGING_ROOT.joinpath(f"{key}.json")
+        pathlib.Path(self.name).mkdir(parents=True, exist_ok=True)
 
-            with lock:
-                if key not in last_called or now - last_called[key] >= wait_seconds:
-                    last_called[key] = now
-                    return func(*args, **kwargs)
+    def cleanup(self):
+        shutil.rmtree(self.name, ignore_errors=True)
+        self.state.unlink(missing_ok=True)
 
-        return wrapper
 
-    return decorator
+def clean_staging(max_age=86400):
+    # partial downloads of jobs that never came back
+    for item in STAGING_ROOT.glob("*"):
+        if time.time() - item.stat().st_mtime > max_age:
+            logging.info("Removing stale staging item %s", item)
+            if item.is_dir():
+                shutil.rmtree(item, ignore_errors=True)
+            else:
+                item.unlink(missing_ok=True)
 
 
 def get_caption(url, video_path):
@@ -124,16 +130,51 @@ def convert_audio_format(video_paths: list, bm):
             video_paths[index] = new_path
 
 
-def split_large_video(video_paths: list):
-    original_video = None
-    split = False
-    for original_video in video_paths:
-        size = os.stat(original_video).st_size
-        if size > TG_NORMAL_MAX_SIZE:
-            split = True
-            logging.warning("file is too large %s, splitting...", size)
-            subprocess.check_output(f"sh split-video.sh {original_video} {TG_NORMAL_MAX_SIZE * 0.95} ".split())
-            os.remove(original_video)
+# every ffmpeg job of this node runs here, so simultaneous downloads can't oversubscribe the CPU.
+# ffmpeg runs in its own process anyway, the threads only wait for it
+ffmpeg_pool = ThreadPoolExecutor(FFMPEG_WORKERS, thread_name_prefix="ffmpeg")
+
+# a media group holds at most 10 items
+SPLIT_PARTS_LIMIT = 10
+# cuts can only land on keyframes, so parts come out somewhat larger than planned
+SPLIT_HEADROOM = 0.9
+
 
-    if split and original_video:
-        return [i for i in pathlib.Path(original_video).parent.glob("*")]
+def split_limit() -> int:
+    # the largest file that can still be delivered after splitting
+    parts = min(SPLIT_MAX_PARTS, SPLIT_PARTS_LIMIT)
+    if parts <= 1:
+        return TG_NORMAL_MAX_SIZE
+    return int(TG_NORMAL_MAX_SIZE * SPLIT_HEADROOM * parts)
+
+
+def split_video(path: pathlib.Path, limit: int = TG_NORMAL_MAX_SIZE) -> list[pathlib.Path]:
+    """
+    Cut a media file into parts smaller than limit with ffmpeg's segment muxer.
+    Streams are copied, not re-encoded, so this takes about as long as reading the file once.
+    """
+    path = pathlib.Path(path)
+    size = path.stat().st_size
+    duration = float(ffmpeg.probe(path)["format"]["duration"])
+    output = path.parent.joinpath(f"{path.stem}.parts")
+    segment = duration * limit * SPLIT_HEADROOM / size
+
+    for _ in range(3):
+        shutil.rmtree(output, ignore_errors=True)
+        output.mkdir()
+        logging.info("Splitting %s(%s) into %.0f seconds segments", path, sizeof_fmt(size), segment)
+        # V skips cover pictures, they can't be segmented
+        command = ["ffmpeg", "-y", "-i", path, "-map", "0:V?", "-map", "0:a?", "-c", "copy", "-f", "segment"]
+        command += ["-segment_time", f"{segment:.3f}", "-reset_timestamps", "1"]
+        subprocess.run([*command, output.joinpath(f"{path.stem}.%03d{path.suffix}")], check=True, capture_output=True)
+
+        parts = sorted(output.glob("*"))
+        largest = max(part.stat().st_size for part in parts)
+        if largest < limit:
+            if len(parts) > SPLIT_PARTS_LIMIT:
+                raise ValueError(f"Your video is too large for Telegram, it needs {len(parts)} parts.")
+            path.unlink()
+            return parts
+        # keyframes are too sparse for the planned cut, try again with shorter segments
+        segment *= limit * SPLIT_HEADROOM / largest
+    raise ValueError(f"Failed to split {path.name} into parts smaller than {sizeof_fmt(limit)}.")
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# ytdlbot - http_client.py
+
+import logging
+import threading
+from typing import Iterator
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from config import ENABLE_HTTP2, HTTP_CONNECT_TIMEOUT, HTTP_POOL_SIZE, HTTP_READ_TIMEOUT, HTTP_RETRIES
+
+
+class HTTPClient:
+    """
+    Process-wide HTTP client for every engine except yt-dlp.
+    Keep-alive connections are pooled per host, requests get default timeouts and retries with backoff,
+    and the client counts requests and bytes so owners can see what it's doing.
+    """
+
+    def __init__(self, pool_size: int = 32, timeout: tuple = (10, 60), retries: int = 3):
+        self.timeout = timeout
+        retry = Retry(
+            total=retries,
+            backoff_factor=0.5,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset({"GET", "HEAD", "OPTIONS"}),
+            raise_on_status=False,
+        )
+        # all sessions share this adapter, therefore the same connection pools
+        self._adapter = HTTPAdapter(pool_connections=64, pool_maxsize=pool_size, max_retries=retry)
+        self._default = self.session()
+        self._lock = threading.Lock()
+        self._requests = 0
+        self._bytes = 0
+
+    def session(self) -> requests.Session:
+        # a separate cookie jar for engines that need one, connections still come from the shared pools
+        s = requests.Session()
+        s.mount("http://", self._adapter)
+        s.mount("https://", self._adapter)
+        return s
+
+    def request(self, method: str, url: str, session: requests.Session = None, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        resp = (session or self._default).request(method, url, **kwargs)
+        with self._lock:
+            self._requests += 1
+        if not kwargs.get("stream"):
+            self.count(len(resp.content))
+        return resp
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def iter_content(self, resp: requests.Response, chunk_size: int) -> Iterator[bytes]:
+        # streamed bodies are counted as they are consumed
+        for chunk in resp.iter_content(chunk_size):
+            self.count(len(chunk))
+            yield chunk
+
+    def count(self, size: int):
+        with self._lock:
+            self._bytes += size
+
+    def stats(self) -> dict:
+        in_use = idle = 0
+        pools = self._adapter.poolmanager.pools
+        with pools.lock:
+            conn_pools = [pools[key] for key in pools.keys()]
+        for pool in conn_pools:
+            queued = list(pool.pool.queue) if pool.pool else []
+            in_use += pool.pool.maxsize - len(queued) if pool.pool else 0
+            idle += sum(1 for conn in queued if conn is not None and conn.sock is not None)
+        return {
+            "hosts": len(conn_pools),
+            "open_connections": in_use + idle,
+            "requests": self._requests,
+            "bytes": self._bytes,
+        }
+
+
+if ENABLE_HTTP2:
+    try:
+        import urllib3.http2
+
+        urllib3.http2.inject_into_urllib3()
+        logging.info("HTTP/2 enabled for engine HTTP client")
+    except ImportError:
+        logging.warning("HTTP/2 needs urllib3>=2.3 and h2, falling back to HTTP/1.1")
+
+http_client = HTTPClient(HTTP_POOL_SIZE, (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT), HTTP_RETRIES)
@@ -3,13 +3,20 @@
 
 # ytdlbot - instagram.py
 
-import time
 import pathlib
 import re
+import threading
+import time
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
 
 import filetype
-import requests
 from engine.base import BaseDownloader
+from engine.http_client import http_client
+from utils import sizeof_fmt, timeof_fmt
+
+CHUNK_SIZE = 64 * 1024
+# carousels have up to 20 items, don't open 20 connections for a single post
+MAX_WORKERS = 4
 
 
 class InstagramDownload(BaseDownloader):
@@ -44,92 +51,49 @@ class InstagramDownload(BaseDownloader):
 
     def _download(self, formats=None):
         try:
-            resp = requests.get(f"http://instagram:15000/?url={self._url}").json()
+            resp = http_client.get(f"http://instagram:15000/?url={self._url}").json()
         except Exception as e:
-            self._bot_msg.edit_text(f"Download failed!❌\n\n`{e}`")
+            self.edit_final(f"Download failed!❌\n\n`{e}`")
             pass
 
         code = self.extract_code()
-        counter = 1
-        video_paths = []
+        items = []
         found_media_types = set()
 
-        if url_results := resp.get("data"):
-            for media in url_results:
-                link = media["link"]
-                media_type = media["type"]
-
-                if media_type == "image":
-                    ext = "jpg"
-                    found_media_types.add("photo")
-                elif media_type == "video":
-                    ext = "mp4"
-                    found_media_types.add("video")
-                else:
-                    continue
-
+        for media in resp.get("data") or []:
+            media_type = media["type"]
+            if media_type == "image":
+                found_media_types.add("photo")
+            elif media_type == "video":
+                found_media_types.add("video")
+            else:
+                continue
+            items.append((media["link"], pathlib.Path(self._tempdir.name, f"Instagram_{code}-{len(items) + 1}")))
+
+        self._progress = {"downloaded": 0, "total": 0}
+        self._progress_lock = threading.Lock()
+        self._stop = threading.Event()
+        started = time.time()
+        try:
+            with ThreadPoolExecutor(min(MAX_WORKERS, len(items) or 1)) as pool:
+                futures = [pool.submit(self._fetch, link, save_path) for link, save_path in items]
+                pending = set(futures)
                 try:
-                    req = requests.get(link, stream=True)
-                    length = int(req.headers.get("content-length", 0) or req.headers.get("x-full-image-content-length", 0))
-                    filename = f"Instagram_{code}-{counter}"
-                    save_path = pathlib.Path(self._tempdir.name, filename)
-                    chunk_size = 8192
-                    downloaded = 0
-                    start_time = time.time()
-
-                    with open(save_path, "wb") as fp:
-                        for chunk in req.iter_content(chunk_size):
-                            if chunk:
-                                downloaded += len(chunk)
-                                fp.write(chunk)
-
-                                elapsed_time = time.time() - start_time
-                                if elapsed_time > 0:
-                                    speed = downloaded / elapsed_time  # bytes per second
-
-                                    if speed >= 1024 * 1024:  # MB/s
-                                        speed_str = f"{speed / (1024 * 1024):.2f}MB/s"
-                                    elif speed >= 1024:  # KB/s
-                                        speed_str = f"{speed / 1024:.2f}KB/s"
-                                    else:  # B/s
-                                        speed_str = f"{speed:.2f}B/s"
-
-                                    if length > 0:
-                                        eta_seconds = (length - downloaded) / speed
-                                        if eta_seconds >= 3600:
-                                            eta_str = f"{eta_seconds / 3600:.1f}h"
-                                        elif eta_seconds >= 60:
-                                            eta_str = f"{eta_seconds / 60:.1f}m"
-                                        else:
-                                            eta_str = f"{eta_seconds:.0f}s"
-                                    else:
-                                        eta_str = "N/A"
-                                else:
-                                    speed_str = "N/A"
-                                    eta_str = "N/A"
-
-                                # dictionary for calling the download_hook
-                                d = {
-                                    "status": "downloading",
-                                    "downloaded_bytes": downloaded,
-                                    "total_bytes": length,
-                                    "_speed_str": speed_str,
-                                    "_eta_str": eta_str
-                                }
-
-                                self.download_hook(d)
-
-                    if ext := filetype.guess_extension(save_path):
-                        new_path = save_path.with_suffix(f".{ext}")
-                        save_path.rename(new_path)
-                        save_path = new_path
-
-                    video_paths.append(str(save_path))
-                    counter += 1
-
-                except Exception as e:
-                    self._bot_msg.edit_text(f"Download failed!❌\n\n`{e}`")
-                    return []
+                    while pending:
+                        done, pending = wait(pending, timeout=1, return_when=FIRST_EXCEPTION)
+                        for future in done:
+                            future.result()
+                        self._report(started)
+                finally:
+                    # i.e. the hook rejected the post, stop the other items too
+                    self._stop.set()
+                    for future in pending:
+                        future.cancel()
+            # results are kept in carousel order, so the media group layout stays the same
+            video_paths = [str(future.result()) for future in futures]
+        except Exception as e:
+            self.edit_final(f"Download failed!❌\n\n`{e}`")
+            return []
 
         if "video" in found_media_types:
             self._format = "video"
@@ -140,6 +104,43 @@ class InstagramDownload(BaseDownloader):
 
         return video_paths
 
+    def _fetch(self, link: str, save_path: pathlib.Path) -> pathlib.Path:
+        with http_client.get(link, stream=True) as req:
+            req.raise_for_status()
+            length = int(req.headers.get("content-length", 0) or req.headers.get("x-full-image-content-length", 0))
+            with self._progress_lock:
+                self._progress["total"] += length
+            with open(save_path, "wb") as fp:
+                for chunk in http_client.iter_content(req, CHUNK_SIZE):
+                    if self._stop.is_set():
+                        raise InterruptedError("Download cancelled")
+                    fp.write(chunk)
+                    with self._progress_lock:
+                        self._progress["downloaded"] += len(chunk)
+
+        if ext := filetype.guess_extension(save_path):
+            new_path = save_path.with_suffix(f".{ext}")
+            save_path.rename(new_path)
+            save_path = new_path
+        return save_path
+
+    def _report(self, started: float):
+        # one update for the whole post instead of one per chunk of every item
+        with self._progress_lock:
+            downloaded, total = self._progress["downloaded"], self._progress["total"]
+        elapsed = time.time() - started
+        speed = downloaded / elapsed if elapsed > 0 else 0
+        eta = (total - downloaded) / speed if speed and total else 0
+        self.download_hook(
+            {
+                "status": "downloading",
+                "downloaded_bytes": downloaded,
+                "total_bytes": total,
+                "_speed_str": f"{sizeof_fmt(speed)}/s",
+                "_eta_str": timeof_fmt(eta) or "N/A",
+            }
+        )
+
     def _start(self):
         downloaded_files = self._download()
         self._upload(files=downloaded_files)
@@ -8,14 +8,15 @@ __author__ = "SanujaNS <sanujas@sanuja.biz>"
 import requests
 from bs4 import BeautifulSoup
 from engine.direct import DirectDownload
+from engine.http_client import http_client
 
 
 def krakenfiles_download(client, bot_message, url: str):
-    session = requests.Session()
+    session = http_client.session()
 
     def _extract_form_data(url: str) -> list[tuple[str, str]]:
         try:
-            resp = session.get(url)
+            resp = http_client.get(url, session=session)
             resp.raise_for_status()
             soup = BeautifulSoup(resp.content, "html.parser")
 
@@ -38,7 +39,7 @@ def krakenfiles_download(client, bot_message, url: str):
     def _get_download_url(form_data: list[tuple[str, str]]) -> str:
         for post_url, data in form_data:
             try:
-                response = session.post(post_url, data=data)
+                response = http_client.post(post_url, session=session, data=data)
                 response.raise_for_status()
 
                 json_data = response.json()
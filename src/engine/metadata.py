@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# ytdlbot - metadata.py
+
+import logging
+from pathlib import Path
+from urllib.parse import urlparse
+
+import ffmpeg
+import filetype
+
+from engine.http_client import http_client
+
+# Telegram rejects thumbnails larger than 320px on either side
+THUMB_MAX = 320
+THUMB_SCALE = ("if(gt(iw,ih),300,-1)", "if(gt(iw,ih),-1,300)")
+# larger photos are only accepted as documents
+PHOTO_MAX = 10 * 1024 * 1024
+
+
+def info_metadata(info: dict | None) -> dict:
+    """Width, height and duration from a yt-dlp info dict, fields yt-dlp doesn't know are left out."""
+    if not info:
+        return {}
+    meta = {}
+    # merged formats keep the video dimensions on the video part
+    video = next((f for f in info.get("requested_formats") or [] if f.get("vcodec") not in (None, "none")), {})
+    for key in ("width", "height", "duration"):
+        if value := info.get(key) or video.get(key):
+            meta[key] = int(value)
+    return meta
+
+
+def probe_metadata(path: str | Path) -> dict:
+    try:
+        probe = ffmpeg.probe(path)
+    except Exception as e:
+        logging.error("Error while probing %s: %s", path, e)
+        return {}
+    meta = {}
+    if duration := probe.get("format", {}).get("duration"):
+        meta["duration"] = int(float(duration))
+    for stream in probe.get("streams", []):
+        # skip cover pictures embedded by yt-dlp
+        if stream.get("codec_type") == "video" and not stream.get("disposition", {}).get("attached_pic"):
+            meta["width"], meta["height"] = stream.get("width", 0), stream.get("height", 0)
+            break
+    return meta
+
+
+def media_type(path: str | Path, info: dict | None = None) -> str:
+    """The send method that fits the file: video, animation, audio, photo or document."""
+    mime = filetype.guess_mime(str(path)) or ""
+    if mime == "image/gif":
+        return "animation"
+    if mime.startswith("image/"):
+        return "photo" if Path(path).stat().st_size <= PHOTO_MAX else "document"
+
+    info = info or {}
+    if info.get("vcodec") is not None and info.get("acodec") is not None:
+        has_video, has_audio = info["vcodec"] != "none", info["acodec"] != "none"
+    else:
+        try:
+            streams = ffmpeg.probe(path).get("streams", [])
+        except Exception as e:
+            logging.error("Error while probing %s: %s", path, e)
+            return "document"
+        kinds = {s.get("codec_type") for s in streams if not s.get("disposition", {}).get("attached_pic")}
+        has_video, has_audio = "video" in kinds, "audio" in kinds
+
+    if has_video:
+        return "video"
+    if has_audio:
+        return "audio"
+    return "document"
+
+
+def info_thumbnail(info: dict | None, dest: str | Path) -> str | None:
+    """Fetch the thumbnail yt-dlp found, scaled down only if none of them is small enough already."""
+    thumbnails = [t for t in (info or {}).get("thumbnails") or [] if t.get("url")]
+    if not thumbnails:
+        return None
+
+    def fits(t: dict) -> bool:
+        small = 0 < (t.get("width") or 0) <= THUMB_MAX and 0 < (t.get("height") or 0) <= THUMB_MAX
+        return small and urlparse(t["url"]).path.lower().endswith((".jpg", ".jpeg"))
+
+    fitting = [t for t in thumbnails if fits(t)]
+    # yt-dlp sorts thumbnails from worst to best
+    thumbnail = max(fitting, key=lambda t: t["width"]) if fitting else thumbnails[-1]
+    try:
+        resp = http_client.get(thumbnail["url"])
+        resp.raise_for_status()
+        if fitting:
+            Path(dest).write_bytes(resp.content)
+        else:
+            # decoding a single image is cheap, unlike seeking in the video
+            ffmpeg.input("pipe:").filter("scale", *THUMB_SCALE).output(str(dest), vframes=1).run(
+                input=resp.content, quiet=True
+            )
+        return str(dest)
+    except Exception as e:
+        logging.warning("Failed to fetch thumbnail %s: %s", thumbnail["url"], e)
+        return None
+
+
+def keyframe_thumbnail(path: str | Path, duration: int, dest: str | Path) -> str | None:
+    """Render the first keyframe after the middle of the video, without decoding anything in between."""
+    try:
+        ffmpeg.input(str(path), ss=duration / 2, skip_frame="nokey").filter("scale", *THUMB_SCALE).output(
+            str(dest), vframes=1
+        ).run(quiet=True)
+    except (ffmpeg.Error, OSError) as e:
+        logging.warning("Failed to render thumbnail of %s: %s", path, e)
+        return None
+    # nothing is written if there is no keyframe after the seek point
+    return str(dest) if Path(dest).exists() else None
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# ytdlbot - progress.py
+
+from tqdm import tqdm
+
+# same look as tqdm(ncols=30, unit_scale=True, bar_format="{l_bar}{bar} |{n_fmt}/{total_fmt} ")
+NCOLS = 30
+CHARSET = " " + "".join(map(chr, range(0x258F, 0x2587, -1)))
+
+
+def render_bar(total, finished) -> tuple[str, str]:
+    """The bar and the `n/total` detail, without constructing a tqdm object for every update."""
+    n_fmt = tqdm.format_sizeof(finished)
+    if total and finished < total + 0.5:
+        frac = finished / total
+        l_bar = f"{frac * 100:3.0f}%|"
+        detail = f"{n_fmt}/{tqdm.format_sizeof(total)} "
+        width = max(1, NCOLS - len(l_bar) - 2 - len(detail))
+        # same rounding as tqdm.std.Bar
+        length, partial = divmod(int(max(0.0, min(1.0, frac)) * width * 8), 8)
+        bar = CHARSET[-1] * length
+        if length < width:
+            bar += CHARSET[partial] + " " * (width - length - 1)
+    else:
+        # tqdm shows an empty bar when the total is unknown or exceeded
+        detail = f"{n_fmt}/{'?' if total is None or total else tqdm.format_sizeof(total)} "
+        bar = " " * max(1, NCOLS - 3 - len(detail))
+    return f"{bar} ", detail
+
+
+def render_progress(desc, total, finished, speed="", eta="") -> str:
+    def more(title, initial):
+        if initial:
+            return f"{title} {initial}"
+        else:
+            return ""
+
+    bar, detail = render_bar(total, finished)
+    return f"""
+    {desc}
+
+    `[{bar}]`
+    {detail}
+    {more("Speed:", speed)}
+    {more("ETA:", eta)}
+        """
+
+
+if __name__ == "__main__":
+    # micro-benchmark against the previous tqdm based implementation: python src/engine/progress.py
+    import random
+    import timeit
+    from io import StringIO
+
+    def tqdm_progress(desc, total, finished, speed="", eta=""):
+        def more(title, initial):
+            if initial:
+                return f"{title} {initial}"
+            else:
+                return ""
+
+        f = StringIO()
+        tqdm(
+            total=total,
+            initial=finished,
+            file=f,
+            ascii=False,
+            unit_scale=True,
+            ncols=30,
+            bar_format="{l_bar}{bar} |{n_fmt}/{total_fmt} ",
+        )
+        raw_output = f.getvalue()
+        tqdm_output = raw_output.split("|")
+        progress = f"`[{tqdm_output[1]}]`"
+        # tqdm's close() echoes the line after a carriage return, which ended up in the message
+        detail = tqdm_output[2].replace("[A", "").split("\r")[0]
+        text = f"""
+    {desc}
+
+    {progress}
+    {detail}
+    {more("Speed:", speed)}
+    {more("ETA:", eta)}
+        """
+        f.close()
+        return text
+
+    cases = [(0, 0), (None, 5), (10, 20), (100, 100), (2_000_000_000, 1_999_999_999.7)]
+    for _ in range(20000):
+        total = random.choice([random.randint(1, 10**4), random.randint(1, 2 * 10**9), random.random() * 10**7])
+        cases.append((total, random.uniform(0, total)))
+    for total, finished in cases:
+        expected = tqdm_progress("Downloading...", total, finished, "1.00MiB/s", "10s")
+        assert render_progress("Downloading...", total, finished, "1.00MiB/s", "10s") == expected, (total, finished)
+
+    args = ("Downloading...", 27_000_000, 12_300_000, "1.00MiB/s", "10s")
+    for func in (tqdm_progress, render_progress):
+        seconds = min(timeit.repeat(lambda: func(*args), number=2000, repeat=5)) / 2000
+        print(f"{func.__name__}: {seconds * 1e6:.1f} µs per call")
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# ytdlbot - scheduler.py
+
+import itertools
+import logging
+import threading
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Any, Callable
+
+
+@dataclass
+class Job:
+    uid: int
+    func: Callable[..., Any]
+    args: tuple = ()
+    kwargs: dict = field(default_factory=dict)
+    seq: int = 0
+    # told the new queue position whenever it changes while the job is pending
+    on_position: Callable[[int], None] | None = None
+    position: int = 0
+
+
+class JobScheduler:
+    """
+    Bounded download queue sitting in front of the engine entrances.
+
+    At most `workers` jobs run at the same time, a single user never has more than `per_user` jobs in flight,
+    and pending jobs are handed out round-robin across users so one user can't starve everyone else.
+    """
+
+    def __init__(self, workers: int, per_user: int):
+        self._workers = max(1, workers)
+        self._per_user = max(1, per_user)
+        # uid -> pending jobs, ordering of the dict is the round-robin rotation
+        self._pending: OrderedDict[int, deque[Job]] = OrderedDict()
+        self._running: dict[int, int] = {}
+        self._cond = threading.Condition()
+        self._counter = itertools.count(1)
+        self._threads = []
+
+    def start(self):
+        with self._cond:
+            if self._threads:
+                return
+            for i in range(self._workers):
+                t = threading.Thread(target=self._worker, name=f"download-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+        logging.info("Job scheduler started with %s workers, %s per user", self._workers, self._per_user)
+
+    def submit(self, uid: int, func: Callable[..., Any], *args, on_position=None, **kwargs) -> int:
+        """
+        Enqueue a job and return its position in the queue, 0 if it starts immediately.
+        `on_position` is called with the new position when it changes later on, e.g. as jobs ahead are picked up.
+        """
+        job = Job(uid, func, args, kwargs, next(self._counter), on_position)
+        with self._cond:
+            self._pending.setdefault(uid, deque()).append(job)
+            job.position = self._position(job)
+            # round-robin, a new user's job can overtake jobs already queued
+            moved = self._reposition()
+            self._cond.notify()
+        self._announce(moved)
+        return job.position
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "running": sum(self._running.values()),
+                "pending": sum(len(q) for q in self._pending.values()),
+                "users": len(self._pending.keys() | self._running.keys()),
+            }
+
+    def _position(self, job: Job) -> int:
+        index = self._pending[job.uid].index(job)
+        return self._rank(job.uid, index, self._handed_out(index), self._workers - sum(self._running.values()))
+
+    def _handed_out(self, index: int) -> int:
+        # how many jobs the round-robin hands out before the one at this index of its user's queue
+        return sum(min(len(q), index + 1) for q in self._pending.values()) - 1
+
+    def _rank(self, uid: int, index: int, ahead: int, free: int) -> int:
+        # 0 means it will be picked up right away
+        if ahead < free and self._running.get(uid, 0) + index < self._per_user:
+            return 0
+        return ahead + 1
+
+    def _reposition(self) -> list[tuple[Job, int]]:
+        """Pending jobs whose position changed since they were last told, with the lock held."""
+        free = self._workers - sum(self._running.values())
+        handed_out, moved = {}, []
+        for uid, queue in self._pending.items():
+            for index, job in enumerate(queue):
+                if job.on_position is None:
+                    continue
+                if index not in handed_out:
+                    handed_out[index] = self._handed_out(index)
+                position = self._rank(uid, index, handed_out[index], free)
+                if position != job.position:
+                    job.position = position
+                    if position:
+                        moved.append((job, position))
+        return moved
+
+    @staticmethod
+    def _announce(moved: list[tuple[Job, int]]):
+        for job, position in moved:
+            try:
+                job.on_position(position)
+            except Exception:
+                logging.error("Position update of job %s failed", job.seq, exc_info=True)
+
+    def _next_job(self) -> Job | None:
+        for uid in list(self._pending):
+            queue = self._pending[uid]
+            if self._running.get(uid, 0) >= self._per_user:
+                continue
+            job = queue.popleft()
+            if queue:
+                # move this user to the back of the rotation
+                self._pending.move_to_end(uid)
+            else:
+                del self._pending[uid]
+            self._running[uid] = self._running.get(uid, 0) + 1
+            return job
+        return None
+
+    def _done(self, job: Job):
+        with self._cond:
+            self._running[job.uid] -= 1
+            if not self._running[job.uid]:
+                del self._running[job.uid]
+            # a user slot was freed, maybe someone else's job is runnable now
+            self._cond.notify_all()
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while (job := self._next_job()) is None:
+                    self._cond.wait()
+                moved = self._reposition()
+            self._announce(moved)
+            try:
+                job.func(*job.args, **job.kwargs)
+            except Exception:
+                logging.error("Job %s for user %s failed", job.seq, job.uid, exc_info=True)
+            finally:
+                self._done(job)
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# ytdlbot - segmented.py
+
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Callable
+
+import requests
+
+from engine.http_client import http_client
+from utils import sizeof_fmt, timeof_fmt
+
+CHUNK_SIZE = 1024 * 1024
+PIECE_MIN, PIECE_MAX = 1024 * 1024, 32 * 1024 * 1024
+RETRIES = 5
+
+
+class SegmentedDownload:
+    """
+    Download a file over several connections with HTTP range requests, each piece is written in place at its offset.
+    Falls back to a single stream when the server doesn't support ranges.
+
+    With a `state` path, finished pieces and the validators of the remote file are recorded there,
+    so a later run for the same path continues where the last one stopped if the remote file is unchanged.
+
+    A `sink` is told the size with `begin(total)` once the file exists and every byte range on disk with
+    `written(start, end)`, i.e. to upload the file while it is being downloaded.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        path: Path,
+        connections: int = 8,
+        hook: Callable[[dict], None] = None,
+        state: Path | None = None,
+        sink=None,
+    ):
+        self._url = url
+        self._path = Path(path)
+        self._state_path = state
+        self._state = {}
+        self._connections = max(1, connections)
+        self._hook = hook
+        self._sink = sink
+        # ranges must be served byte for byte, don't let the server compress them
+        self._headers = {"Accept-Encoding": "identity"}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._started = 0.0
+        self._resumed = 0
+        self.downloaded = 0
+        self.total = 0
+
+    def start(self) -> Path:
+        self._started = time.time()
+        headers = {**self._headers, "Range": "bytes=0-0"}
+        with http_client.get(self._url, headers=headers, stream=True) as resp:
+            resp.raise_for_status()
+            match = re.search(r"/(\d+)$", resp.headers.get("content-range", ""))
+            if resp.status_code != 206 or not match:
+                logging.info("%s doesn't support range requests, using a single connection", self._url)
+                return self._single(resp)
+            # follow redirects only once
+            self._url = resp.url
+            self.total = int(match.group(1))
+            validators = {"etag": resp.headers.get("etag"), "last_modified": resp.headers.get("last-modified")}
+
+        # the hook rejects files that are too large, before anything is downloaded
+        self._report()
+        self._state = self._load_state(validators)
+        piece, finished = self._state["piece"], set(self._state["done"])
+        pieces = deque(
+            (offset, min(offset + piece, self.total) - 1)
+            for offset in range(0, self.total, piece)
+            if offset not in finished
+        )
+        self._resumed = self.downloaded = self.total - sum(end - start + 1 for start, end in pieces)
+        logging.info("Downloading %s in %s pieces of %s", self._url, len(pieces), sizeof_fmt(piece))
+
+        if not finished:
+            with open(self._path, "wb") as f:
+                f.truncate(self.total)
+        fd = os.open(self._path, os.O_WRONLY)
+        if self._sink:
+            self._sink.begin(self.total)
+            for start in finished:
+                self._sink.written(start, min(start + piece, self.total))
+        try:
+            with ThreadPoolExecutor(self._connections) as pool:
+                pending = {pool.submit(self._worker, fd, pieces) for _ in range(min(self._connections, len(pieces)))}
+                try:
+                    while pending:
+                        done, pending = wait(pending, timeout=1, return_when=FIRST_EXCEPTION)
+                        for future in done:
+                            future.result()
+                        self._report()
+                finally:
+                    self._stop.set()
+        finally:
+            os.close(fd)
+        if self._state_path:
+            self._state_path.unlink(missing_ok=True)
+        return self._path
+
+    def _load_state(self, validators: dict) -> dict:
+        fresh = {
+            "url": self._url,
+            **validators,
+            "total": self.total,
+            "piece": min(max(self.total // (self._connections * 4), PIECE_MIN), PIECE_MAX),
+            "done": [],
+        }
+        if not self._state_path or not self._state_path.exists() or not self._path.exists():
+            return fresh
+        try:
+            state = json.loads(self._state_path.read_text())
+        except ValueError:
+            return fresh
+
+        # without validators there is no way to tell whether the remote file changed in between
+        unchanged = any(validators.values()) and all(state.get(k) == v for k, v in validators.items())
+        if unchanged and state.get("total") == self.total and self._path.stat().st_size == self.total:
+            logging.info("Resuming %s with %s finished pieces", self._url, len(state["done"]))
+            return state
+        return fresh
+
+    def _piece_done(self, start: int):
+        if not self._state_path:
+            return
+        with self._lock:
+            self._state["done"].append(start)
+            tmp = self._state_path.with_suffix(".tmp")
+            tmp.write_text(json.dumps(self._state))
+            os.replace(tmp, self._state_path)
+
+    def _single(self, resp: requests.Response) -> Path:
+        self.total = int(resp.headers.get("content-length", 0))
+        last = 0
+        with open(self._path, "wb") as f:
+            if self._sink:
+                self._sink.begin(self.total)
+            for chunk in http_client.iter_content(resp, CHUNK_SIZE):
+                f.write(chunk)
+                # flushed so the sink can read the bytes back right away
+                f.flush()
+                if self._sink:
+                    self._sink.written(self.downloaded, self.downloaded + len(chunk))
+                self.downloaded += len(chunk)
+                if time.time() - last >= 1:
+                    self._report()
+                    last = time.time()
+        return self._path
+
+    def _worker(self, fd: int, pieces: deque):
+        while not self._stop.is_set():
+            try:
+                start, end = pieces.popleft()
+            except IndexError:
+                return
+            self._fetch(fd, start, end)
+
+    def _fetch(self, fd: int, start: int, end: int):
+        offset = start
+        for attempt in range(1, RETRIES + 1):
+            try:
+                headers = {**self._headers, "Range": f"bytes={offset}-{end}"}
+                with http_client.get(self._url, headers=headers, stream=True) as resp:
+                    if resp.status_code != 206:
+                        raise IOError(f"Range request failed with status {resp.status_code}")
+                    for chunk in http_client.iter_content(resp, CHUNK_SIZE):
+                        if self._stop.is_set():
+                            return
+                        chunk = chunk[: end + 1 - offset]
+                        os.pwrite(fd, chunk, offset)
+                        if self._sink:
+                            self._sink.written(offset, offset + len(chunk))
+                        offset += len(chunk)
+                        with self._lock:
+                            self.downloaded += len(chunk)
+                if offset > end:
+                    self._piece_done(start)
+                    return
+            except (IOError, requests.RequestException) as e:
+                logging.warning("Piece %s-%s failed at %s, attempt %s: %s", start, end, offset, attempt, e)
+                time.sleep(attempt)
+        raise IOError(f"Failed to download bytes {offset}-{end} after {RETRIES} attempts")
+
+    def _report(self):
+        if self._hook is None:
+            return
+        elapsed = time.time() - self._started
+        speed = (self.downloaded - self._resumed) / elapsed if elapsed > 0 else 0
+        eta = (self.total - self.downloaded) / speed if speed and self.total else 0
+        self._hook(
+            {
+                "status": "downloading",
+                "downloaded_bytes": self.downloaded,
+                "total_bytes": self.total,
+                "_speed_str": f"{sizeof_fmt(speed)}/s",
+                "_eta_str": timeof_fmt(eta) or "N/A",
+            }
+        )
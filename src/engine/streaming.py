@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# ytdlbot - streaming.py
+
+import asyncio
+import logging
+import math
+import os
+import threading
+import time
+from concurrent.futures import FIRST_EXCEPTION, Future, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Callable
+
+from pyrogram import raw
+
+from config import Types
+
+PART_SIZE = 512 * 1024
+# smaller files can't be uploaded as big file parts, they go through the normal upload after the download
+BIG_FILE_SIZE = 10 * 1024 * 1024
+WORKERS = 4
+RETRIES = 3
+
+
+class StreamingUpload:
+    """
+    Upload a file to Telegram while it is still being downloaded.
+
+    The downloader reports every byte range it writes with `written`, each 512 KiB part is sent with
+    `upload.SaveBigFilePart` as soon as all of its bytes are on disk, in whatever order the parts complete.
+    `finish` waits for the remaining parts and returns the InputFileBig to send the message with.
+    """
+
+    def __init__(self, client: Types.Client, path: Path):
+        self._client = client
+        self._path = Path(path)
+        self._lock = threading.Lock()
+        self._pool: ThreadPoolExecutor | None = None
+        self._futures: list[Future] = []
+        self._filled: list[int] = []
+        self._fd: int | None = None
+        self._session = None
+        self.file_id = 0
+        self.parts = 0
+        self.total = 0
+        self.uploaded = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self._pool is not None
+
+    def _run(self, coro):
+        # session and storage coroutines aren't sync-wrapped by pyrogram, run them on the client's loop
+        return asyncio.run_coroutine_threadsafe(coro, self._client.loop).result()
+
+    def begin(self, total: int):
+        """Called once the size is known and the file exists on disk."""
+        if total <= BIG_FILE_SIZE:
+            return
+        self.total = total
+        self.parts = math.ceil(total / PART_SIZE)
+        self._filled = [0] * self.parts
+        self.file_id = self._client.rnd_id()
+        self._session = self._run(self._client.get_session(self._run(self._client.storage.dc_id()), is_media=True))
+        # the downloader may rename the file before we are done, keep reading from the same inode
+        self._fd = os.open(self._path, os.O_RDONLY)
+        self._pool = ThreadPoolExecutor(WORKERS, thread_name_prefix="stream-upload")
+        logging.info("Streaming upload of %s in %s parts", self._path, self.parts)
+
+    def written(self, start: int, end: int):
+        """Bytes start..end(exclusive) are on disk, ranges never overlap."""
+        end = min(end, self.total)
+        if not self.enabled or start >= end:
+            return
+        with self._lock:
+            for part in range(start // PART_SIZE, (end - 1) // PART_SIZE + 1):
+                low, high = part * PART_SIZE, min((part + 1) * PART_SIZE, self.total)
+                self._filled[part] += min(end, high) - max(start, low)
+                if self._filled[part] == high - low:
+                    self._futures.append(self._pool.submit(self._send_part, part))
+
+    def _send_part(self, part: int):
+        data = os.pread(self._fd, PART_SIZE, part * PART_SIZE)
+        rpc = raw.functions.upload.SaveBigFilePart(
+            file_id=self.file_id, file_part=part, file_total_parts=self.parts, bytes=data
+        )
+        for attempt in range(1, RETRIES + 1):
+            try:
+                if self._run(self._session.invoke(rpc)):
+                    break
+            except Exception as e:
+                logging.warning("Part %s of %s failed, attempt %s: %s", part, self._path, attempt, e)
+            time.sleep(attempt)
+        else:
+            raise IOError(f"Failed to upload part {part} after {RETRIES} attempts")
+        with self._lock:
+            self.uploaded += len(data)
+
+    def finish(self, name: str, progress: Callable[[int, int], None] = None) -> raw.types.InputFileBig:
+        """Wait for the parts still in flight, the download must be complete by now."""
+        try:
+            with self._lock:
+                missing = [
+                    part
+                    for part, size in enumerate(self._filled)
+                    if size != min(PART_SIZE, self.total - part * PART_SIZE)
+                ]
+                pending = set(self._futures)
+            if missing:
+                raise IOError(f"{len(missing)} parts of {self._path} were never written")
+            while pending:
+                done, pending = wait(pending, timeout=1, return_when=FIRST_EXCEPTION)
+                for future in done:
+                    future.result()
+                if progress:
+                    progress(self.uploaded, self.total)
+            return raw.types.InputFileBig(id=self.file_id, parts=self.parts, name=name)
+        finally:
+            self.abort()
+
+    def abort(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+            self._pool = None
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
@@ -7,32 +7,34 @@
 
 __author__ = "Benny <benny.think@gmail.com>"
 
+import json
 import logging
 import os
 import re
 import threading
 import time
 import typing
-from io import BytesIO
 from typing import Any
 
 import psutil
 import pyrogram.errors
 import yt_dlp
 from apscheduler.schedulers.background import BackgroundScheduler
-from pyrogram import Client, enums, filters, types
+from pyrogram import Client, enums, filters, idle, types
 
 from config import (
     APP_HASH,
     APP_ID,
     AUTHORIZED_USER,
     BOT_TOKEN,
+    BULK_FREE_RESET,
     ENABLE_ARIA2,
     ENABLE_FFMPEG,
     M3U8_SUPPORT,
     ENABLE_VIP,
     OWNER,
     PROVIDER_TOKEN,
+    QUOTA_FLUSH_INTERVAL,
     TOKEN_PRICE,
     BotText,
 )
@@ -43,10 +45,16 @@ from database.model import (
     get_paid_quota,
     get_quality_settings,
     init_user,
+    flush_quota,
     reset_free,
     set_user_settings,
 )
-from engine import direct_entrance, youtube_entrance, special_download_entrance
+from database import LeaseBusy, Redis, lease_watcher
+from database.backend import EVENTS, cache_stats
+from engine import direct_entrance, scheduler, special_download_entrance, youtube_entrance
+from engine.governor import delay_queue, governor
+from engine.helper import clean_staging
+from engine.http_client import http_client
 from utils import extract_url_and_name, sizeof_fmt, timeof_fmt
 
 logging.info("Authorized users are %s", AUTHORIZED_USER)
@@ -66,6 +74,10 @@ def create_app(name: str, workers: int = 64) -> Client:
 
 
 app = create_app("main")
+# queued and running jobs, so they can be picked up again after a restart
+journal = Redis()
+JOURNAL_KEY = f"jobs:{str(BOT_TOKEN).split(':')[0]}"
+ENTRANCES = {f.__name__: f for f in (direct_entrance, special_download_entrance, youtube_entrance)}
 
 
 def private_use(func):
@@ -203,6 +215,23 @@ def successful_payment(client: Client, message: types.Message):
     message.delete()
 
 
+def cache_report(top: int = 5) -> str:
+    # hits/misses/evictions per tier, overall and for the busiest domains
+    def fmt(counts: dict) -> str:
+        return " | ".join(f"{tier} {'/'.join(str(c[e]) for e in EVENTS)}" for tier, c in counts.items())
+
+    stats = cache_stats.snapshot()
+    totals, per_domain = {}, {}
+    for tier, domains in stats.items():
+        totals[tier] = {e: sum(c[e] for c in domains.values()) for e in EVENTS}
+        for domain, counts in domains.items():
+            per_domain.setdefault(domain, {})[tier] = counts
+    busiest = sorted(per_domain.items(), key=lambda item: -sum(c["hits"] + c["misses"] for c in item[1].values()))
+    lines = [f"<b>File Cache (hits/misses/evictions):</b> {fmt(totals) or 'unused'}"]
+    lines += [f"  {domain}: {fmt(counts)}" for domain, counts in busiest[:top]]
+    return "\n".join(lines) + "\n"
+
+
 @app.on_message(filters.command(["stats"]))
 def stats_handler(client: Client, message: types.Message):
     chat_id = message.chat.id
@@ -213,6 +242,10 @@ def stats_handler(client: Client, message: types.Message):
     swap = psutil.swap_memory()
     memory = psutil.virtual_memory()
     boot_time = psutil.boot_time()
+    queue = scheduler.stats()
+    http = http_client.stats()
+    edits = governor.stats()
+    parked = delay_queue.stats()
 
     owner_stats = (
         "\n\n⌬─────「 Stats 」─────⌬\n\n"
@@ -227,6 +260,14 @@ def stats_handler(client: Client, message: types.Message):
         f"<b>SWAP Total:</b> {sizeof_fmt(swap.total)} | <b>SWAP Usage:</b> {swap.percent}%\n\n"
         f"<b>Total Disk Space:</b> {sizeof_fmt(total)}\n"
         f"<b>Used:</b> {sizeof_fmt(used)} | <b>Free:</b> {sizeof_fmt(free)}\n\n"
+        f"<b>Download Queue:</b> {queue['running']} running | {queue['pending']} pending | "
+        f"{lease_watcher().pending()} waiting for the same video\n"
+        f"<b>HTTP Client:</b> {http['open_connections']} connections to {http['hosts']} hosts | "
+        f"{http['requests']} requests | {sizeof_fmt(http['bytes'])}\n"
+        f"<b>Progress Edits:</b> {edits['pending']} pending | {edits['sent']} sent | {edits['dropped']} dropped | "
+        f"{edits['held']} chats on hold\n"
+        f"<b>Flood Wait:</b> {parked['parked']} parked | next retry in {timeof_fmt(parked['next']) or '0s'}\n"
+        f"{cache_report()}\n"
         f"<b>Physical Cores:</b> {psutil.cpu_count(logical=False)}\n"
         f"<b>Total Cores:</b> {psutil.cpu_count(logical=True)}\n\n"
         f"<b>🤖Bot Uptime:</b> {timeof_fmt(time.time() - botStartTime)}\n"
@@ -279,6 +320,91 @@ def settings_handler(client: Client, message: types.Message):
     client.send_message(chat_id, BotText.settings.format(quality, send_type), reply_markup=markup)
 
 
+def flood_notice(client: Client, message: types.Message, e: pyrogram.errors.Flood):
+    # never sleeps, the caller parks whatever hit the flood wait in the delay queue
+    logging.warning("Flood wait %s seconds for chat %s", e.value, message.chat.id)
+    try:
+        message.reply_text(f"Flood wait! Your job will be retried automatically in {e.value} seconds.", quote=True)
+        for owner in OWNER:
+            client.send_message(owner, f"Flood wait! 🙁 {e.value} seconds....")
+    except pyrogram.errors.Flood:
+        # these will most likely be rate limited too, the job is parked anyway
+        pass
+    except Exception as ex:
+        logging.warning("Failed to send flood notice: %s", ex)
+
+
+def download_job(client: Client, message: types.Message, bot_msg: types.Message, entrance, url: str, cleanup=False):
+    parked = False
+    try:
+        entrance(client, bot_msg, url)
+    except pyrogram.errors.Flood as e:
+        # the worker moves on to other jobs, this one is submitted again once the wait is over
+        parked = True
+        flood_notice(client, message, e)
+        delay_queue.defer(e.value, enqueue_download, client, message, bot_msg, entrance, url, cleanup)
+    except LeaseBusy as e:
+        # waiting for another job to fetch the same video would hold a download slot, resubmitted once it's done
+        parked = True
+        try:
+            bot_msg.edit_text("The same video is being downloaded, please wait...")
+        except pyrogram.errors.RPCError as err:
+            logging.warning("Failed to edit %s: %s", bot_msg.id, err)
+        journal.on_release(e.key, enqueue_download, client, message, bot_msg, entrance, url, cleanup)
+    except ValueError as e:
+        message.reply_text(e.__str__(), quote=True)
+        if cleanup:
+            bot_msg.delete()
+    except Exception as e:
+        logging.error("Download failed", exc_info=True)
+        message.reply_text(f"❌ Download failed: {e}", quote=True)
+    finally:
+        governor.finish(bot_msg)
+        # a parked job stays in the journal, so a restart restores it too
+        if not parked:
+            journal.r.hdel(JOURNAL_KEY, f"{bot_msg.chat.id}:{bot_msg.id}")
+
+
+def enqueue_download(client: Client, message: types.Message, bot_msg: types.Message, entrance, url: str, cleanup=False):
+    uid = getattr(message.from_user, "id", message.chat.id)
+    job = dict(
+        chat_id=bot_msg.chat.id,
+        message_id=message.id,
+        bot_msg_id=bot_msg.id,
+        entrance=entrance.__name__,
+        url=url,
+        cleanup=cleanup,
+    )
+    journal.r.hset(JOURNAL_KEY, f"{bot_msg.chat.id}:{bot_msg.id}", json.dumps(job))
+    text = bot_msg.text
+
+    def show_position(position: int):
+        # the job is queued already, a flood wait here must not fail the caller
+        governor.update(bot_msg, f"{text}\nQueue position: {position}")
+
+    position = scheduler.submit(
+        uid, download_job, client, message, bot_msg, entrance, url, cleanup, on_position=show_position
+    )
+    if position:
+        show_position(position)
+
+
+def restore_jobs(client: Client):
+    # jobs interrupted by a restart, the engines continue from the partial files in staging
+    for field, raw in journal.r.hgetall(JOURNAL_KEY).items():
+        job = json.loads(raw)
+        journal.r.hdel(JOURNAL_KEY, field)
+        try:
+            message, bot_msg = client.get_messages(job["chat_id"], [job["message_id"], job["bot_msg_id"]])
+            if message.empty or bot_msg.empty:
+                continue
+            logging.info("Restoring job %s for %s", field, job["url"])
+            bot_msg = bot_msg.edit_text("Bot restarted, your download will continue.")
+            enqueue_download(client, message, bot_msg, ENTRANCES[job["entrance"]], job["url"], job["cleanup"])
+        except Exception as e:
+            logging.warning("Failed to restore job %s: %s", field, e)
+
+
 @app.on_message(filters.command(["direct"]))
 def direct_download(client: Client, message: types.Message):
     chat_id = message.chat.id
@@ -291,12 +417,7 @@ def direct_download(client: Client, message: types.Message):
         message.reply_text("Send me a correct LINK.", quote=True)
         return
     bot_msg = message.reply_text("Direct download request received.", quote=True)
-    try:
-        direct_entrance(client, bot_msg, url)
-    except ValueError as e:
-        message.reply_text(e.__str__(), quote=True)
-        bot_msg.delete()
-        return
+    enqueue_download(client, message, bot_msg, direct_entrance, url, cleanup=True)
 
 
 @app.on_message(filters.command(["spdl"]))
@@ -311,12 +432,7 @@ def spdl_handler(client: Client, message: types.Message):
         message.reply_text("Something wrong 🤔.\nCheck your URL and send me again.", quote=True)
         return
     bot_msg = message.reply_text("SPDL request received.", quote=True)
-    try:
-        special_download_entrance(client, bot_msg, url)
-    except ValueError as e:
-        message.reply_text(e.__str__(), quote=True)
-        bot_msg.delete()
-        return
+    enqueue_download(client, message, bot_msg, special_download_entrance, url, cleanup=True)
 
 
 @app.on_message(filters.command(["ytdl"]) & filters.group)
@@ -332,12 +448,7 @@ def ytdl_handler(client: Client, message: types.Message):
         return
 
     bot_msg = message.reply_text("Group download request received.", quote=True)
-    try:
-        youtube_entrance(client, bot_msg, url)
-    except ValueError as e:
-        message.reply_text(e.__str__(), quote=True)
-        bot_msg.delete()
-        return
+    enqueue_download(client, message, bot_msg, youtube_entrance, url, cleanup=True)
 
 
 def check_link(url: str):
@@ -364,16 +475,10 @@ def download_handler(client: Client, message: types.Message):
         # raise pyrogram.errors.exceptions.FloodWait(10)
         bot_msg: types.Message | Any = message.reply_text("Task received.", quote=True)
         client.send_chat_action(chat_id, enums.ChatAction.UPLOAD_VIDEO)
-        youtube_entrance(client, bot_msg, url)
+        enqueue_download(client, message, bot_msg, youtube_entrance, url)
     except pyrogram.errors.Flood as e:
-        f = BytesIO()
-        f.write(str(e).encode())
-        f.write(b"Your job will be done soon. Just wait!")
-        f.name = "Please wait.txt"
-        message.reply_document(f, caption=f"Flood wait! Please wait {e} seconds...", quote=True)
-        f.close()
-        client.send_message(OWNER, f"Flood wait! 🙁 {e} seconds....")
-        time.sleep(e.value)
+        flood_notice(client, message, e)
+        delay_queue.defer(e.value, download_handler, client, message)
     except ValueError as e:
         message.reply_text(e.__str__(), quote=True)
     except Exception as e:
@@ -401,8 +506,12 @@ def quality_callback(client: Client, callback_query: types.CallbackQuery):
 
 if __name__ == "__main__":
     botStartTime = time.time()
-    scheduler = BackgroundScheduler()
-    scheduler.add_job(reset_free, "cron", hour=0, minute=0)
+    cron = BackgroundScheduler()
+    if BULK_FREE_RESET:
+        cron.add_job(reset_free, "cron", hour=0, minute=0)
+    cron.add_job(clean_staging, "interval", hours=1)
+    cron.add_job(flush_quota, "interval", seconds=QUOTA_FLUSH_INTERVAL)
+    cron.start()
     scheduler.start()
     banner = f"""
 ▌ ▌         ▀▛▘     ▌       ▛▀▖              ▜            ▌
@@ -413,4 +522,8 @@ if __name__ == "__main__":
 By @BennyThink, VIP Mode: {ENABLE_VIP} 
     """
     print(banner)
-    app.run()
+    app.start()
+    restore_jobs(app)
+    idle()
+    app.stop()
+    flush_quota()
@@ -4,6 +4,7 @@
 # ytdlbot - __init__.py.py
 
 
+import functools
 import logging
 import pathlib
 import re
@@ -12,9 +13,10 @@ import tempfile
 import time
 import uuid
 from http.cookiejar import MozillaCookieJar
-from urllib.parse import quote_plus, urlparse
+from urllib.parse import parse_qsl, quote_plus, urlencode, urlparse
 
 import ffmpeg
+import yt_dlp
 
 
 def sizeof_fmt(num: int, suffix="B"):
@@ -35,6 +37,12 @@ def timeof_fmt(seconds: int | float):
     return result
 
 
+def source_domain(url: str) -> str:
+    """The site a URL points to, i.e. youtube.com for https://www.youtube.com/watch?v=ID"""
+    host = (urlparse(url).hostname or "").lower()
+    return host.removeprefix("www.").removeprefix("m.")
+
+
 def is_youtube(url: str) -> bool:
     try:
         if not url or not isinstance(url, str):
@@ -47,6 +55,53 @@ def is_youtube(url: str) -> bool:
         return False
 
 
+# query parameters that only track where a link was shared from, they never change the media itself
+TRACKING_PARAMS = {"si", "feature", "pp", "fbclid", "gclid", "igsh", "igshid", "ref", "ref_src", "share_id", "spm"}
+
+
+def normalize_url(url: str) -> str:
+    # host, path and query without scheme, mobile/www prefixes, fragment and tracking parameters
+    parsed = urlparse(url.strip())
+    host = (parsed.hostname or "").lower()
+    for prefix in ("www.", "m.", "mobile."):
+        host = host.removeprefix(prefix)
+    if parsed.port and parsed.port not in (80, 443):
+        host = f"{host}:{parsed.port}"
+    path = parsed.path.rstrip("/") or "/"
+    query = sorted(
+        (k, v)
+        for k, v in parse_qsl(parsed.query, keep_blank_values=True)
+        if k.lower() not in TRACKING_PARAMS and not k.lower().startswith("utm_")
+    )
+    return f"{host}{path}?{urlencode(query)}" if query else f"{host}{path}"
+
+
+# extractors whose URL forms differ only in ways that never change the media, so they can be reduced to the
+# video id. Others keep path and query, i.e. bilibili's ?p=2 or twitter's /photo/2 pick one item of a post
+EQUIVALENT_FORMS = ("Youtube",)
+
+
+@functools.lru_cache(maxsize=4096)
+def canonical_url(url: str, extractor: bool = True) -> str:
+    """
+    Map a URL to a stable media identity, so different links to the same video share one cache entry.
+    i.e. youtu.be/ID, youtube.com/watch?v=ID&t=30 and youtube.com/shorts/ID all become `Youtube:ID`
+    """
+    if extractor:
+        for key in EQUIVALENT_FORMS:
+            ie = yt_dlp.extractor.get_info_extractor(key)
+            if not ie.suitable(url):
+                continue
+            try:
+                if video_id := ie.get_temp_id(url):
+                    return f"{key}:{video_id}"
+            except Exception as e:
+                logging.warning("Failed to get video id for %s: %s", url, e)
+            break
+
+    return normalize_url(url)
+
+
 def adjust_formats(formats):
     # high: best quality 1080P, 2K, 4K, 8K
     # medium: 720P
@@ -0,0 +1,14 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# ytdlbot - conftest.py
+
+import os
+import sys
+import tempfile
+
+# the bot runs from src/ with absolute imports, and the config reads its settings at import time
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "src"))
+os.environ.setdefault("OWNER", "1")
+os.environ.setdefault("DB_DSN", "sqlite:///" + os.path.join(tempfile.gettempdir(), "ytdlbot-test.db"))
+os.environ.setdefault("CACHE_BACKEND", "redis")
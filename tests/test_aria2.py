@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+# ytdlbot - test_aria2.py
+
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import pytest
+
+from engine import direct
+from engine.aria2 import Aria2
+from engine.direct import DirectDownload
+
+
+class StubAria2(BaseHTTPRequestHandler):
+    """Answers aria2 JSON-RPC calls, the download completes on the second poll."""
+
+    calls: list = []
+    polls = 0
+    fail = False
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        type(self).calls.append(request)
+        method = request["method"]
+        if method == "aria2.addUri":
+            result = "gid1"
+        elif method == "system.multicall":
+            type(self).polls += 1
+            status = {"gid": "gid1", "totalLength": "100", "downloadSpeed": "10", "files": []}
+            if self.fail:
+                status.update(status="error", completedLength="0", errorMessage="stub failure")
+            elif self.polls < 2:
+                status.update(status="active", completedLength="50")
+            else:
+                status.update(status="complete", completedLength="100", files=[{"path": "/stub/video.mp4"}])
+            result = [[status] for _ in request["params"][0]]
+        else:
+            result = "OK"
+        body = json.dumps({"jsonrpc": "2.0", "id": request["id"], "result": result}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    StubAria2.calls, StubAria2.polls, StubAria2.fail = [], 0, False
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubAria2)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    client = Aria2(f"http://127.0.0.1:{server.server_port}/jsonrpc", "secret")
+    monkeypatch.setattr(direct, "aria2", client)
+    yield StubAria2
+    server.shutdown()
+    server.server_close()
+
+
+def downloader(progress: list):
+    return SimpleNamespace(
+        _url="https://example.com/video.mp4",
+        _bot_msg=SimpleNamespace(edit_text=lambda text: None),
+        _tempdir=SimpleNamespace(name="/stub"),
+        download_hook=progress.append,
+    )
+
+
+def test_aria2_download(stub):
+    progress = []
+    files = DirectDownload._aria2_download(downloader(progress))
+
+    assert files == ["/stub/video.mp4"]
+    assert progress and progress[0]["downloaded_bytes"] == 50 and progress[0]["total_bytes"] == 100
+    add = next(call for call in stub.calls if call["method"] == "aria2.addUri")
+    assert add["params"][:2] == ["token:secret", ["https://example.com/video.mp4"]]
+    assert add["params"][2]["dir"] == "/stub"
+    # every status poll is a single batched call with the token inside each call
+    poll = next(call for call in stub.calls if call["method"] == "system.multicall")
+    assert poll["params"][0][0]["params"][:2] == ["token:secret", "gid1"]
+
+
+def test_aria2_download_error(stub):
+    stub.fail = True
+    with pytest.raises(Exception, match="stub failure"):
+        DirectDownload._aria2_download(downloader([]))
+    assert any(call["method"] == "aria2.remove" for call in stub.calls)